@@ -0,0 +1,113 @@
+import logging
+import shlex
+import threading
+
+import discord
+
+try:
+    import av
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE = av is not None
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+FRAME_SAMPLES = discord.opus.Encoder.SAMPLES_PER_FRAME
+SILENCE = bytes(FRAME_SIZE)
+
+
+def input_options(before_options):
+    """Turns ffmpeg input flags (``-reconnect 1 ...``) into the options dict PyAV takes."""
+    args = shlex.split(before_options or '')
+    options = {}
+    for flag, value in zip(args, args[1:]):
+        if flag.startswith('-') and not value.startswith('-'):
+            options[flag[1:]] = value
+    return options
+
+
+class AVAudioSource(discord.AudioSource):
+    """Decodes a local file or a stream URL in-process with PyAV.
+
+    The container, decoder and resampler are set up once per source and
+    produce 20 ms frames of 48 kHz stereo PCM directly, so each read is one
+    copy out of the decoder's frame buffer instead of a subprocess writing
+    through a pipe. Decoders aren't shared between sources: each is set up
+    from its own stream's parameters, and the copy stays because the mixer
+    and the opus encoder work on ``bytes``.
+
+    Opening (connecting and probing) happens on a helper thread right away.
+    Reads return silence until it's done, so a slow stream never holds up
+    the audio thread; :attr:`started` is set once real audio was read.
+    """
+
+    def __init__(self, url, *, options=None, timeout=(10, 30)):
+        if not AVAILABLE:
+            raise RuntimeError('PyAV is not installed')
+        self.url = url
+        self._options = options or {}
+        self._timeout = timeout
+        self._container = None
+        self._frames = None
+        self._closed = False
+        self.started = False
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        threading.Thread(target=self._open, name='av-open', daemon=True).start()
+
+    def read(self):
+        if not self._ready.is_set():
+            return SILENCE
+        frames = self._frames
+        if frames is None:
+            return b''
+        try:
+            frame = next(frames, None)
+        except av.error.FFmpegError as e:
+            logger.warning('Decoding %s failed: %s', self.url, e)
+            return b''
+        if frame is None:
+            return b''
+        data = bytes(memoryview(frame.planes[0])[:frame.samples * 4])
+        if len(data) < FRAME_SIZE:
+            # The resampler flushes a short last frame
+            data += bytes(FRAME_SIZE - len(data))
+        self.started = True
+        return data
+
+    def cleanup(self):
+        with self._lock:
+            self._closed = True
+            container, self._container = self._container, None
+            self._frames = None
+        if container is not None:
+            container.close()
+
+    def _open(self):
+        try:
+            container = av.open(self.url, options=self._options, timeout=self._timeout)
+            stream = container.streams.audio[0]
+            resampler = av.AudioResampler(format='s16', layout='stereo', rate=48000, frame_size=FRAME_SAMPLES)
+        except (av.error.FFmpegError, IndexError, OSError) as e:
+            logger.warning('Could not open %s: %s', self.url, e)
+            self._ready.set()
+            return
+
+        with self._lock:
+            if self._closed:
+                container.close()
+            else:
+                self._container = container
+                self._frames = self._decode(container, stream, resampler)
+        self._ready.set()
+
+    def _decode(self, container, stream, resampler):
+        for packet in container.demux(stream):
+            try:
+                frames = packet.decode()
+            except av.error.InvalidDataError:
+                continue  # A corrupt packet in a stream, skip to the next one
+            for frame in frames:
+                yield from resampler.resample(frame)
+        yield from resampler.resample(None)
@@ -0,0 +1,787 @@
+"""Benchmarks the playback paths without a Discord connection.
+
+Drives the soundboard, radio and /play callbacks of :class:`somalezu.Music`
+with fake interactions and voice clients for 1, 10 and 100 concurrent guilds.
+Audio goes through the real mixer, relays, ffmpeg processes and discord.py's
+``AudioPlayer``; only the UDP socket is left out, packets are counted
+instead. The clips come from ``sounds/`` and a local HTTP server stands in
+for the radio stations and for extracted tracks. Results are written as JSON
+so runs can be compared::
+
+    python benchmark.py --guilds 1,10,100 --duration 10
+    python benchmark.py --compare .cache/benchmarks/before.json
+
+The soak mode instead keeps hundreds of guilds pressing soundboard buttons
+and switching radio stations for hours, reporting the event loop's lag and
+the memory use every few minutes::
+
+    python benchmark.py --soak 4h --soak-guilds 300
+"""
+import argparse
+import asyncio
+import ctypes.util
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+# Importing the bot needs these, the benchmark never logs in
+os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+os.environ.setdefault('GUILD_ID', '0')
+
+import discord
+from discord.opus import OPUS_SILENCE
+from discord.player import AudioPlayer
+
+import somalezu
+from guild_state import process_rss
+from loop_watchdog import LoopWatchdog, percentile
+from mixer import FRAME_INTERVAL, SILENCE
+from somalezu import Music, PaginatedSoundboardView, RadioView, SoundButton
+
+logger = logging.getLogger(__name__)
+
+SCENARIOS = ('soundboard', 'radio', 'music')
+# One local station per button of the radio view
+STATIONS = 6
+# Chunk length the fake stations send at, in seconds, after a one second burst on connect
+STREAM_CHUNK = 0.05
+# Higher is better for these, lower for every other compared value
+HIGHER_IS_BETTER = {'fps_mean', 'fps_min'}
+COMPARED = ('first_frame_p95_ms', 'fps_min', 'cpu_percent_per_stream', 'peak_rss_mb')
+
+
+def child_usage():
+    """Returns ``{pid: (cpu_seconds, rss_bytes)}`` for the live children of this process (Linux only)."""
+    usage = {}
+    pid = str(os.getpid())
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return usage
+    ticks, page = os.sysconf('SC_CLK_TCK'), os.sysconf('SC_PAGE_SIZE')
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as fp:
+                stat = fp.read().decode(errors='replace')
+        except OSError:
+            continue
+        fields = stat[stat.rindex(')') + 2:].split()
+        if fields[1] == pid:
+            usage[int(entry)] = ((int(fields[11]) + int(fields[12])) / ticks, int(fields[21]) * page)
+    return usage
+
+
+def cpu_seconds():
+    """CPU time used so far by this process and by its children, exited or not."""
+    times = os.times()
+    live = sum(cpu for cpu, _ in child_usage().values())
+    return times.user + times.system + times.children_user + times.children_system + live
+
+
+class ResourceSampler(threading.Thread):
+    """Samples the resident memory of the bot process and of its children."""
+
+    def __init__(self, interval=0.1):
+        super().__init__(name='benchmark-sampler', daemon=True)
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_children_rss = 0
+        self._finished = threading.Event()
+
+    def run(self):
+        while not self._finished.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, process_rss() or 0)
+            self.peak_children_rss = max(self.peak_children_rss, sum(rss for _, rss in child_usage().values()))
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+
+
+class StreamStats:
+    """Frame timing of one fake voice connection."""
+    __slots__ = ('frames', 'late', 'intervals', 'playing', 'last', 'first_frames', '_requested', '_started')
+
+    def __init__(self):
+        self.frames = 0
+        self.late = 0
+        self.intervals = 0  # Between frames of the same player, and how long they added up to
+        self.playing = 0.0
+        self.last = None
+        self.first_frames = []  # Seconds from each request to its first audible frame
+        self._requested = None
+        self._started = False
+
+    def restart(self):
+        """A new player started, the gap since the last one isn't a late frame."""
+        self.last = None
+
+    def request(self):
+        """Marks the start of an interaction expected to produce audio."""
+        self._requested = time.perf_counter()
+        self._started = False
+
+    def layer_started(self):
+        self._started = True
+
+    def sent(self, silent):
+        now = time.perf_counter()
+        # Gaps of a second or more are the player being paused
+        if self.last is not None and now - self.last < 1.0:
+            self.intervals += 1
+            self.playing += now - self.last
+            if now - self.last > 2 * FRAME_INTERVAL:
+                self.late += 1
+        self.last = now
+        self.frames += 1
+        # Radio relays send silence until the station delivers, that doesn't count as started
+        if self._started and not silent and self._requested is not None:
+            self.first_frames.append(now - self._requested)
+            self._requested = None
+
+    @property
+    def fps(self):
+        return self.intervals / self.playing if self.playing else 0.0
+
+
+class FakeVoiceWebSocket:
+    async def speak(self, state):
+        pass
+
+
+class FakeVoiceClient:
+    """Enough of :class:`discord.VoiceClient` for the real ``AudioPlayer``, counting packets instead of sending them."""
+
+    def __init__(self, bot, guild, channel):
+        self.client = bot
+        self.guild = guild
+        self.channel = channel
+        self.ws = FakeVoiceWebSocket()
+        self.timeout = 5.0
+        self.encoder = None
+        self.stats = StreamStats()
+        self.players = []
+        self._player = None
+
+    def is_connected(self):
+        return True
+
+    def wait_until_connected(self, timeout=None):
+        return True
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        if not source.is_opus():
+            self.encoder = discord.opus.Encoder()
+        self.stats.restart()
+        self._player = AudioPlayer(source, self, after=after)
+        self.players.append(self._player)
+        self._player.start()
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    @source.setter
+    def source(self, value):
+        self._player.set_source(value)
+
+    def send_audio_packet(self, data, *, encode=True):
+        if encode:
+            silent = data == SILENCE
+            self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+        else:
+            silent = data == OPUS_SILENCE
+        self.stats.sent(silent)
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self.interaction.messages.append(content)
+
+    async def edit_message(self, *, content=None, **kwargs):
+        self._done = True
+        self.interaction.messages.append(content)
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.messages.append(content)
+
+
+class FakeInteraction:
+    def __init__(self, bot, voice_client, user):
+        self.client = bot
+        self.guild = voice_client.guild
+        self.user = user
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.messages = []
+
+
+class FakeVoiceSessions:
+    """Every fake guild is connected up front, so there's nothing to ensure."""
+
+    def record_use(self, user_id):
+        pass
+
+    async def ensure(self, channel, *, move=False):
+        return channel.guild.voice_client
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.user = SimpleNamespace(id=0)
+        self.voice_sessions = FakeVoiceSessions()
+        self.guilds = {}
+        self.commands = {}
+
+    def get_guild(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def add_command(self, command):
+        self.commands[command.name] = command
+
+    def remove_command(self, name):
+        return self.commands.pop(name, None)
+
+
+class BenchmarkMusic(Music):
+    """Tells the fake voice client when a new layer starts, to time its first audible frame."""
+
+    def play_music(self, voice_client, source, *, on_start=None, **kwargs):
+        return super().play_music(voice_client, source, on_start=self._started(voice_client, on_start), **kwargs)
+
+    def play_clip(self, voice_client, source, *, on_start=None, **kwargs):
+        return super().play_clip(voice_client, source, on_start=self._started(voice_client, on_start), **kwargs)
+
+    @staticmethod
+    def _started(voice_client, on_start):
+        def started():
+            voice_client.stats.layer_started()
+            if on_start is not None:
+                on_start()
+        return started
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """Serves ``/station/<n>`` as an endless stream paced in real time and ``/track/<name>`` as a file."""
+
+    def do_GET(self):
+        if self.path.startswith('/station/'):
+            self.stream()
+        elif self.path.startswith('/track/'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.send_header('Content-Length', str(len(self.server.track)))
+            self.end_headers()
+            try:
+                self.wfile.write(self.server.track)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            self.send_error(404)
+
+    def stream(self):
+        audio, rate = self.server.audio, self.server.byte_rate
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.end_headers()
+        looped = audio * 2
+        offset = int(rate)
+        chunk = int(rate * STREAM_CHUNK)
+        next_time = time.perf_counter()
+        try:
+            self.wfile.write(looped[:offset])
+            while not self.server.closing:
+                self.wfile.write(looped[offset:offset + chunk])
+                offset = (offset + chunk) % len(audio)
+                next_time += STREAM_CHUNK
+                time.sleep(max(0.0, next_time - time.perf_counter()))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, sound, *, track_seconds):
+        super().__init__(('127.0.0.1', 0), StreamHandler)
+        self.audio = Path(sound.path).read_bytes()
+        self.byte_rate = len(self.audio) / sound.duration
+        # Repeated so a track outlasts the benchmark
+        self.track = self.audio * max(1, int(track_seconds / sound.duration) + 1)
+        self.closing = False
+        threading.Thread(target=self.serve_forever, name='benchmark-server', daemon=True).start()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_address[1]}{path}'
+
+    def close(self):
+        self.closing = True
+        self.shutdown()
+        self.server_close()
+
+
+class Benchmark:
+    def __init__(self, bot, cog, server, *, press_interval=1.0):
+        self.bot = bot
+        self.cog = cog
+        self.server = server
+        self.press_interval = press_interval
+        self.track_url = None
+        self._run = 0
+
+    async def prepare_track(self):
+        """Puts a fresh extracted track in the extraction cache and measures it, as if played before."""
+        self._run += 1
+        url = self.server.url(f'/track/{self._run}.mp3')
+        data = {
+            'id': str(self._run), 'extractor': 'benchmark', 'title': f'Benchmark track {self._run}',
+            'url': url, 'webpage_url': url, 'acodec': 'mp3', 'duration': len(self.server.track) / self.server.byte_rate,
+        }
+        somalezu.extraction_cache.put(somalezu.normalize_url(url), data)
+        # Served from this machine, it's measured like a cached or library file would be
+        future = somalezu.track_loudness.measure(somalezu.track_key(data), {**data, 'local': True})
+        if future is not None:
+            await asyncio.wrap_future(future)
+        self.track_url = url
+
+    def connect(self, count):
+        clients = []
+        for guild_id in range(1, count + 1):
+            guild = SimpleNamespace(id=guild_id, name=f'Guild {guild_id}', voice_client=None)
+            channel = SimpleNamespace(id=guild_id, guild=guild, bitrate=64000)
+            guild.voice_client = FakeVoiceClient(self.bot, guild, channel)
+            self.bot.guilds[guild_id] = guild
+            clients.append(guild.voice_client)
+        return clients
+
+    async def disconnect(self, clients):
+        for voice_client in clients:
+            self.cog.release(voice_client.guild.id)
+            voice_client.stop()
+            self.bot.guilds.pop(voice_client.guild.id, None)
+        players = [player for voice_client in clients for player in voice_client.players]
+        await asyncio.get_running_loop().run_in_executor(None, lambda: [player.join(5) for player in players])
+        somalezu.radio_relays.close()
+
+    def interaction(self, voice_client):
+        user = SimpleNamespace(id=voice_client.guild.id, voice=SimpleNamespace(channel=voice_client.channel))
+        return FakeInteraction(self.bot, voice_client, user)
+
+    async def soundboard(self, voice_client, deadline):
+        view = PaginatedSoundboardView(voice_client, self.cog)
+        interaction = self.interaction(voice_client)
+        while time.perf_counter() < deadline:
+            await random.choice((view.previous_page, view.next_page))(interaction)
+            button = random.choice([item for item in view.children if isinstance(item, SoundButton)])
+            voice_client.stats.request()
+            await button.callback(interaction)
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.press_interval)
+
+    async def radio(self, voice_client, deadline):
+        view = RadioView(voice_client, self.cog)
+        station = voice_client.guild.id % STATIONS
+        voice_client.stats.request()
+        await view.play_radio(self.interaction(voice_client), self.server.url(f'/station/{station}'), f'Station {station}')
+
+    async def music(self, voice_client, deadline):
+        voice_client.stats.request()
+        await self.cog.play.callback(self.cog, self.interaction(voice_client), self.track_url)
+
+    async def soak_guild(self, voice_client, deadline, radio_share):
+        """Presses soundboard buttons, switching to another radio station instead every now and then."""
+        soundboard = PaginatedSoundboardView(voice_client, self.cog)
+        radio = RadioView(voice_client, self.cog)
+        interaction = self.interaction(voice_client)
+        while time.perf_counter() < deadline:
+            voice_client.stats.request()
+            if random.random() < radio_share:
+                station = random.randrange(STATIONS)
+                await radio.play_radio(interaction, self.server.url(f'/station/{station}'), f'Station {station}')
+            else:
+                await random.choice((soundboard.previous_page, soundboard.next_page))(interaction)
+                button = random.choice([item for item in soundboard.children if isinstance(item, SoundButton)])
+                await button.callback(interaction)
+            # Sent messages pile up on the fake interaction, not in the bot
+            interaction.messages.clear()
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.press_interval)
+
+    async def soak(self, guilds, duration, *, radio_share, report_interval, watchdog, on_report):
+        """Soaks ``guilds`` guilds for ``duration`` seconds, passing the rows so far to ``on_report`` off the loop."""
+        clients = self.connect(guilds)
+        await self.cog.cog_load()
+        started = time.perf_counter()
+        deadline = started + duration
+        tasks = [asyncio.ensure_future(self.soak_guild(voice_client, deadline, radio_share)) for voice_client in clients]
+        rows, lags = [], []
+        intervals = playing = late = 0
+        loop = asyncio.get_running_loop()
+        try:
+            while time.perf_counter() < deadline:
+                await asyncio.sleep(min(report_interval, deadline - time.perf_counter()))
+                now = time.perf_counter()
+                window = watchdog.snapshot(reset=True)
+                lags.extend(window['lags'])
+                total_intervals = sum(voice_client.stats.intervals for voice_client in clients)
+                total_playing = sum(voice_client.stats.playing for voice_client in clients)
+                total_late = sum(voice_client.stats.late for voice_client in clients)
+                # Reading /proc takes a while with hundreds of processes, keep it off the measured loop
+                children = await loop.run_in_executor(None, child_usage)
+                rows.append({
+                    'elapsed_s': round(now - started, 1),
+                    'lag_p50_ms': _ms(window['p50']),
+                    'lag_p99_ms': _ms(window['p99']),
+                    'lag_max_ms': _ms(window['max']),
+                    'stalls': len(watchdog.stalls),
+                    'fps_mean': round((total_intervals - intervals) / (total_playing - playing or 1), 2),
+                    'late_frames': total_late - late,
+                    'rss_mb': round((process_rss() or 0) / 1024 ** 2, 1),
+                    'children_rss_mb': round(sum(rss for _, rss in children.values()) / 1024 ** 2, 1),
+                    'guild_states': len(self.cog.guilds),
+                    'relays': len(somalezu.radio_relays.relays),
+                })
+                intervals, playing, late = total_intervals, total_playing, total_late
+                await loop.run_in_executor(None, on_report, rows)
+        finally:
+            for task in tasks:
+                task.cancel()
+            errors = [result for result in await asyncio.gather(*tasks, return_exceptions=True)
+                      if isinstance(result, Exception)]
+            for error in errors[:3]:
+                logger.error('A soaking guild failed', exc_info=error)
+            await self.cog.cog_unload()
+            await self.disconnect(clients)
+        return rows, lags, len(errors)
+
+    async def run(self, scenario, guilds, duration):
+        if scenario == 'music':
+            await self.prepare_track()
+        clients = self.connect(guilds)
+        sampler = ResourceSampler()
+        sampler.start()
+        cpu_before = cpu_seconds()
+        started = time.perf_counter()
+        deadline = started + duration
+        results = await asyncio.gather(
+            *(getattr(self, scenario)(voice_client, deadline) for voice_client in clients), return_exceptions=True,
+        )
+        await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds() - cpu_before
+        sampler.stop()
+        await self.disconnect(clients)
+
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for error in errors[:3]:
+            logger.error('%s failed in a guild', scenario, exc_info=error)
+        first_frames = [value for voice_client in clients for value in voice_client.stats.first_frames]
+        fps = [voice_client.stats.fps for voice_client in clients]
+        return {
+            'scenario': scenario,
+            'guilds': guilds,
+            'duration': round(elapsed, 3),
+            'first_frames': len(first_frames),
+            'first_frame_p50_ms': _ms(percentile(first_frames, 0.5)),
+            'first_frame_p95_ms': _ms(percentile(first_frames, 0.95)),
+            'first_frame_max_ms': _ms(max(first_frames, default=None)),
+            'fps_mean': round(sum(fps) / len(fps), 2),
+            'fps_min': round(min(fps), 2),
+            'late_frames': sum(voice_client.stats.late for voice_client in clients),
+            'silent_guilds': sum(1 for voice_client in clients if not voice_client.stats.first_frames),
+            'cpu_percent_per_stream': round(100 * cpu / elapsed / guilds, 3),
+            'peak_rss_mb': round(sampler.peak_rss / 1024 ** 2, 1),
+            'peak_children_rss_mb': round(sampler.peak_children_rss / 1024 ** 2, 1),
+            'errors': len(errors),
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def load_opus(path):
+    if discord.opus.is_loaded():
+        return True
+    path = path or ctypes.util.find_library('opus')
+    if path:
+        try:
+            discord.opus.load_opus(path)
+        except OSError as e:
+            logger.error('Could not load libopus from %s: %s', path, e)
+    return discord.opus.is_loaded()
+
+
+def print_results(results):
+    columns = (
+        'scenario', 'guilds', 'first_frame_p50_ms', 'first_frame_p95_ms', 'fps_mean', 'fps_min',
+        'late_frames', 'cpu_percent_per_stream', 'peak_rss_mb', 'peak_children_rss_mb', 'errors',
+    )
+    rows = [columns, *([str(result[column]) for column in columns] for result in results)]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def compare(baseline, results, tolerance):
+    """Prints how ``results`` changed from ``baseline``. Returns the number of regressions beyond ``tolerance``."""
+    previous = {(result['scenario'], result['guilds']): result for result in baseline['results']}
+    regressions = 0
+    for result in results:
+        before = previous.get((result['scenario'], result['guilds']))
+        if before is None:
+            continue
+        for key in COMPARED:
+            old, new = before.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if key in HIGHER_IS_BETTER else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions += 1
+            print(f'{result["scenario"]:>10} {result["guilds"]:>4} {key:>24}: {old:g} -> {new:g} ({change:+.1%}){flag}')
+    return regressions
+
+
+def growth_per_hour(rows, key):
+    """The least squares slope of ``key`` over the soak, per hour."""
+    if len(rows) < 2:
+        return None
+    xs = [row['elapsed_s'] / 3600 for row in rows]
+    ys = [row[key] for row in rows]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return None
+    return round(sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance, 2)
+
+
+def soak_summary(rows, lags, stalls, errors):
+    stacks = {}
+    for stall in stalls:
+        count, longest = stacks.get(stall.stack, (0, 0.0))
+        stacks[stall.stack] = (count + 1, max(longest, stall.duration or 0.0))
+    return {
+        'lag_p50_ms': _ms(percentile(lags, 0.5)),
+        'lag_p99_ms': _ms(percentile(lags, 0.99)),
+        'lag_p999_ms': _ms(percentile(lags, 0.999)),
+        'lag_max_ms': _ms(max(lags, default=None)),
+        'rss_first_mb': rows[0]['rss_mb'] if rows else None,
+        'rss_last_mb': rows[-1]['rss_mb'] if rows else None,
+        'rss_growth_mb_per_hour': growth_per_hour(rows, 'rss_mb'),
+        'children_rss_growth_mb_per_hour': growth_per_hour(rows, 'children_rss_mb'),
+        'errors': errors,
+        # The most frequent blocking stacks, longest first among equals
+        'stalls': [
+            {'count': count, 'longest_ms': _ms(longest), 'stack': stack}
+            for stack, (count, longest) in sorted(stacks.items(), key=lambda item: item[1], reverse=True)[:5]
+        ],
+    }
+
+
+def duration(value):
+    """Parses ``90``, ``30m`` or ``4h`` into seconds."""
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if value[-1:] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+async def soak(args, report, write):
+    bot = FakeBot(asyncio.get_running_loop())
+    cog = BenchmarkMusic(bot)
+    await cog.refresh_sounds()
+    somalezu.media_cache.min_plays = sys.maxsize
+    watchdog = LoopWatchdog(
+        interval=args.lag_interval, threshold=args.block_threshold,
+        window=int(args.report_interval / args.lag_interval) + 100,
+    )
+    watchdog.start()
+
+    def on_report(rows):
+        row = rows[-1]
+        print(
+            f'{row["elapsed_s"]:>8.0f}s  lag p99 {row["lag_p99_ms"]} ms, max {row["lag_max_ms"]} ms, '
+            f'{row["stalls"]} stalls, {row["fps_mean"]} fps, RSS {row["rss_mb"]} MiB '
+            f'(+{row["children_rss_mb"]} MiB children), {row["guild_states"]} guild states',
+            file=sys.stderr,
+        )
+        report['samples'] = rows
+        write()
+
+    longest = max(cog.sound_index, key=lambda sound: sound.duration or 0)
+    server = StreamServer(longest, track_seconds=60)
+    bench = Benchmark(bot, cog, server, press_interval=args.press_interval)
+    try:
+        rows, lags, errors = await bench.soak(
+            args.soak_guilds, args.soak,
+            radio_share=args.radio_share, report_interval=args.report_interval,
+            watchdog=watchdog, on_report=on_report,
+        )
+    finally:
+        watchdog.close()
+        server.close()
+        somalezu.track_loudness.close()
+    report['samples'] = rows
+    report['summary'] = soak_summary(rows, lags, watchdog.stalls, errors)
+    write()
+
+
+async def benchmark(args):
+    loop = asyncio.get_running_loop()
+    bot = FakeBot(loop)
+    cog = BenchmarkMusic(bot)
+    await cog.refresh_sounds()
+    # Counted plays would move the track into the media cache halfway through a run
+    somalezu.media_cache.min_plays = sys.maxsize
+
+    longest = max(cog.sound_index, key=lambda sound: sound.duration or 0)
+    server = StreamServer(longest, track_seconds=args.duration + 10)
+    bench = Benchmark(bot, cog, server, press_interval=args.press_interval)
+    results = []
+    try:
+        for scenario in args.scenarios:
+            # Warms the clip cache, the relays and ffmpeg before anything is measured
+            await bench.run(scenario, 1, min(2.0, args.duration))
+            for guilds in args.guilds:
+                print(f'Running {scenario} with {guilds} guild(s) for {args.duration:g}s...', file=sys.stderr)
+                results.append(await bench.run(scenario, guilds, args.duration))
+    finally:
+        server.close()
+        somalezu.track_loudness.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), type=lambda value: value.split(','),
+                        help='comma separated scenarios to run (default: %(default)s)')
+    parser.add_argument('--guilds', default='1,10,100', type=lambda value: [int(n) for n in value.split(',')],
+                        help='comma separated numbers of concurrent guilds (default: %(default)s)')
+    parser.add_argument('--duration', default=10.0, type=float, help='seconds per run (default: %(default)s)')
+    parser.add_argument('--press-interval', default=1.0, type=float,
+                        help='average seconds between soundboard presses per guild (default: %(default)s)')
+    parser.add_argument('--output', help='where to write the JSON results (default: .cache/benchmarks/<kind>-<time>.json)')
+    parser.add_argument('--compare', metavar='BASELINE', help='a previous results file to compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative change counted as a regression (default: %(default)s)')
+    parser.add_argument('--soak', type=duration, metavar='DURATION',
+                        help='run the soak test for this long (like 90, 30m or 4h) instead of the benchmarks')
+    parser.add_argument('--soak-guilds', default=300, type=int,
+                        help='concurrent guilds in the soak test (default: %(default)s)')
+    parser.add_argument('--radio-share', default=0.1, type=float,
+                        help='share of soak actions that switch radio stations (default: %(default)s)')
+    parser.add_argument('--report-interval', default=60.0, type=duration,
+                        help='seconds between soak reports (default: %(default)s)')
+    parser.add_argument('--lag-interval', default=0.1, type=float,
+                        help='seconds between event loop lag samples (default: %(default)s)')
+    parser.add_argument('--block-threshold', default=0.25, type=float,
+                        help='seconds of loop lag after which the blocking stack is recorded (default: %(default)s)')
+    parser.add_argument('--libopus', help='path of libopus, if it is not found on its own')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    if not load_opus(args.libopus):
+        parser.error('libopus is needed to encode PCM like a voice client does, pass it with --libopus')
+    random.seed(args.seed)
+
+    started = datetime.now()
+    report = {
+        'started': started.isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'audio_backend': somalezu.AUDIO_BACKEND,
+        'opus_passthrough': somalezu.OPUS_PASSTHROUGH,
+    }
+    kind = 'soak' if args.soak else 'benchmark'
+    output = Path(args.output or f'.cache/benchmarks/{kind}-{started:%Y%m%d-%H%M%S}.json')
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    def write():
+        # Rewritten after every soak report, an interrupted soak still leaves its samples behind
+        output.write_text(json.dumps(report, indent=2) + '\n', encoding='utf-8')
+
+    if args.soak:
+        report['soak'] = {
+            'duration': args.soak, 'guilds': args.soak_guilds,
+            'radio_share': args.radio_share, 'press_interval': args.press_interval,
+        }
+        asyncio.run(soak(args, report, write))
+        print(json.dumps({key: value for key, value in report['summary'].items() if key != 'stalls'}, indent=2))
+        for stall in report['summary']['stalls']:
+            print(f'Blocked {stall["count"]} time(s), up to {stall["longest_ms"]} ms, in:\n{stall["stack"]}')
+        print(f'Results written to {output}')
+        return
+
+    results = asyncio.run(benchmark(args))
+    report['results'] = results
+    write()
+    print_results(results)
+    print(f'Results written to {output}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as fp:
+            baseline = json.load(fp)
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
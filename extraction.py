@@ -0,0 +1,394 @@
+import asyncio
+import logging
+import multiprocessing
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+from metrics import EXTRACTION
+
+logger = logging.getLogger(__name__)
+
+YOUTUBE_HOSTS = {'youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com'}
+YOUTUBE_ID = re.compile(r'^[\w-]{11}$')
+EXPIRE_IN_PATH = re.compile(r'/expire/(\d+)')
+
+# The only fields playback needs, everything else stays in the worker process
+INFO_FIELDS = (
+    'id', 'extractor', 'title', 'url', 'webpage_url', 'duration', 'is_live',
+    'acodec', 'ext', 'abr', 'asr', 'http_headers',
+)
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class ExtractionBusy(ExtractionError):
+    """Raised when too many extractions are already queued."""
+
+
+def normalize_url(url):
+    """Returns a cache key for ``url`` so equivalent links share one entry.
+
+    YouTube links of every shape (youtu.be, shorts, music, extra tracking
+    parameters) collapse to ``youtube:<id>``. Music library keys
+    (``library:<path>``) are kept as they are, paths are case-sensitive.
+    Anything else that isn't a URL is treated as a search query.
+    """
+    url = url.strip()
+    if url.startswith('library:'):
+        return url
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return 'search:' + ' '.join(url.lower().split())
+
+    host = parts.netloc.lower()
+    video_id = None
+    if host == 'youtu.be':
+        video_id = parts.path.lstrip('/').split('/')[0]
+    elif host in YOUTUBE_HOSTS:
+        if parts.path == '/watch':
+            video_id = parse_qs(parts.query).get('v', [None])[0]
+        elif parts.path.startswith(('/shorts/', '/live/', '/embed/')):
+            video_id = parts.path.split('/')[2]
+    if video_id and YOUTUBE_ID.match(video_id):
+        return f'youtube:{video_id}'
+
+    query = urlencode(sorted(parse_qs(parts.query).items()), doseq=True)
+    return urlunsplit(('https' if parts.scheme == 'http' else parts.scheme, host, parts.path.rstrip('/'), query, ''))
+
+
+def stream_expiry(data):
+    """Returns the unix time at which the signed stream URL in ``data`` stops working, if known."""
+    url = data.get('url') or ''
+    expire = parse_qs(urlsplit(url).query).get('expire')
+    if expire:
+        try:
+            return float(expire[0])
+        except ValueError:
+            return None
+    match = EXPIRE_IN_PATH.search(url)
+    return float(match.group(1)) if match else None
+
+
+class ExtractionEntry:
+    __slots__ = ('data', 'expires_at')
+
+    def __init__(self, data, expires_at):
+        self.data = data
+        self.expires_at = expires_at
+
+
+class ExtractionCache:
+    """Single-flight, TTL-bounded cache in front of an async extraction function.
+
+    ``fetch`` is a coroutine function taking the original URL and returning the
+    info dict of the track to play. Entries expire when their signed stream URL
+    would stop working before the track could finish, and are transparently
+    re-extracted on the next lookup. Concurrent lookups of the same URL share
+    one in-flight extraction.
+    """
+
+    def __init__(self, fetch, *, max_entries=256, default_ttl=600, margin=60):
+        self._fetch = fetch
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.margin = margin
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._waiters = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, url):
+        key = normalize_url(url)
+        data = self.get_cached(key)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._extract(key, url))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        # Shielded so one caller giving up doesn't cancel the others' extraction,
+        # the extraction itself is only cancelled once every caller gave up
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1:
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def get_cached(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.time():
+            del self._entries[key]
+            logger.debug('Extraction cache entry for %s went stale', key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.data
+
+    def invalidate(self, url):
+        self._entries.pop(normalize_url(url), None)
+
+    def put(self, key, data):
+        expires_at = stream_expiry(data)
+        if expires_at is None:
+            expires_at = time.time() + self.default_ttl
+        else:
+            # The stream has to stay valid until the track is done playing
+            expires_at -= self.margin + (data.get('duration') or 0)
+        if expires_at <= time.time():
+            return
+
+        entry = ExtractionEntry(data, expires_at)
+        keys = {key}
+        if data.get('webpage_url'):
+            keys.add(normalize_url(data['webpage_url']))
+        for k in keys:
+            self._entries[k] = entry
+            self._entries.move_to_end(k)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _extract(self, key, url):
+        data = await self._fetch(url)
+        self.put(key, data)
+        return data
+
+
+def compact_info(data):
+    return {key: data[key] for key in INFO_FIELDS if data.get(key) is not None}
+
+
+def compact_entry(entry):
+    """Reduces a flat playlist entry to what's needed to queue it."""
+    return {
+        'url': entry.get('url') or entry.get('webpage_url'),
+        'title': entry.get('title'),
+        'duration': entry.get('duration'),
+    }
+
+
+def _worker_main(conn, options):
+    """Entry point of an extraction worker: one warmed YoutubeDL serving jobs from ``conn``."""
+    import yt_dlp as youtube_dl
+
+    # Suppress noise about console usage from errors
+    youtube_dl.utils.bug_reports_message = lambda *args, **kwargs: ''
+    ytdl = youtube_dl.YoutubeDL(options)
+    # Load the YouTube extractor up front so the first job doesn't pay for it
+    ytdl.get_info_extractor('Youtube')
+    # Playlists are listed without resolving their entries, one page per job
+    flat_ytdl = youtube_dl.YoutubeDL({**options, 'extract_flat': 'in_playlist', 'lazy_playlist': True})
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        op, url, *args = job
+        try:
+            if op == 'page':
+                start, end = args
+                flat_ytdl.params['playlist_items'] = f'{start}-{end}'
+                data = flat_ytdl.extract_info(url, download=False)
+                if data.get('_type') == 'playlist' or 'entries' in data:
+                    entries = list(data['entries'])
+                    page = {
+                        'title': data.get('title') or url,
+                        'count': len(entries),
+                        'entries': [compact_entry(entry) for entry in entries if entry],
+                    }
+                    if start == 1 and page['entries'] and page['entries'][0]['url']:
+                        # The first track plays right away, resolving it here saves it another job
+                        try:
+                            page['first'] = compact_info(ytdl.extract_info(page['entries'][0]['url'], download=False))
+                        except Exception:
+                            pass
+                    conn.send((True, page))
+                else:
+                    conn.send((True, compact_info(data)))
+                continue
+            if op == 'search':
+                limit, = args
+                flat_ytdl.params['playlist_items'] = f'1-{limit}'
+                data = flat_ytdl.extract_info(f'ytsearch{limit}:{url}', download=False)
+                conn.send((True, [compact_entry(entry) for entry in data.get('entries') or () if entry]))
+                continue
+
+            data = ytdl.extract_info(url, download=False)
+            if 'entries' in data:
+                # take first item from a playlist
+                data = next(iter(data['entries']))
+            conn.send((True, compact_info(data)))
+        except Exception as e:
+            # yt-dlp exceptions don't always pickle, send the message instead
+            conn.send((False, f'{type(e).__name__}: {e}'))
+
+
+class ExtractionWorker:
+    __slots__ = ('process', 'conn')
+
+    def __init__(self, context, options):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, options), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self, reading=None):
+        """Kills the process; the pipe is closed once ``reading`` (a read still blocked on it) returns."""
+        self.process.kill()
+        if reading is None or reading.done():
+            self.conn.close()
+        else:
+            # The killed process closes its end, which ends the read and frees its thread
+            reading.add_done_callback(lambda _: self.conn.close())
+
+    def stop(self):
+        """Blocking: asks the process to exit, killing it if it doesn't within a second."""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.kill()
+
+
+class ExtractionPool:
+    """A bounded pool of worker processes, each owning its own ``YoutubeDL``.
+
+    yt-dlp instances aren't thread-safe and their signature/JS work holds the
+    GIL, so extraction runs in separate processes. Only the fields in
+    :data:`INFO_FIELDS` are sent back. Jobs beyond ``max_queue`` are rejected
+    with :exc:`ExtractionBusy`; a job that times out or whose caller is
+    cancelled gets its worker killed and replaced.
+    """
+
+    def __init__(self, options, *, workers=2, max_queue=16, timeout=30):
+        self.options = dict(options)
+        self.size = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.queued = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = None
+        self._workers = set()
+        self._readers = None
+
+    async def start(self):
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        # Blocking pipe reads happen here, one thread per busy worker. Reads of killed workers
+        # linger until the pipe closes, the spare threads keep them from holding up new jobs.
+        self._readers = ThreadPoolExecutor(max_workers=self.size * 2, thread_name_prefix='extraction-reader')
+        for _ in range(self.size):
+            self._spawn()
+
+    async def close(self):
+        if self._idle is None:
+            return
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, worker.stop) for worker in self._workers))
+        self._workers.clear()
+        self._idle = None
+        self._readers.shutdown(wait=False)
+
+    async def extract(self, url):
+        """Returns the compact info dict for ``url``."""
+        return await self._run(('info', url))
+
+    async def extract_page(self, url, start, end):
+        """Flat-extracts entries ``start`` to ``end`` (1-based, inclusive) of a playlist.
+
+        Returns ``{'title', 'count', 'entries'}`` for playlists, or the compact
+        info dict when ``url`` turns out to be a single track. The first page
+        also carries the first entry's full info as ``'first'`` when it could
+        be resolved.
+        """
+        return await self._run(('page', url, start, end))
+
+    async def search(self, query, limit=10):
+        """Flat-searches YouTube for ``query``, returning up to ``limit`` compact entries."""
+        return await self._run(('search', query, limit))
+
+    async def _run(self, job):
+        if self.queued >= self.max_queue:
+            raise ExtractionBusy(f'{self.queued} extractions already queued')
+        await self.start()
+
+        self.queued += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self.queued -= 1
+
+        started = time.perf_counter()
+        reading = None
+        try:
+            worker.conn.send(job)
+            reading = self._readers.submit(worker.conn.recv)
+            ok, result = await asyncio.wait_for(asyncio.wrap_future(reading), self.timeout)
+        except BaseException as e:
+            EXTRACTION.labels(job[0]).observe(time.perf_counter() - started)
+            # Timed out, cancelled or the worker died: it can't be trusted with the next job
+            self._replace(worker, reading)
+            if isinstance(e, asyncio.TimeoutError):
+                raise ExtractionError(f'extraction timed out after {self.timeout}s') from None
+            if isinstance(e, (EOFError, OSError)):
+                raise ExtractionError('extraction worker died') from e
+            raise
+
+        EXTRACTION.labels(job[0]).observe(time.perf_counter() - started)
+        self._idle.put_nowait(worker)
+        if not ok:
+            raise ExtractionError(result)
+        return result
+
+    def _spawn(self):
+        worker = ExtractionWorker(self._context, self.options)
+        self._workers.add(worker)
+        self._idle.put_nowait(worker)
+
+    def _replace(self, worker, reading=None):
+        logger.warning('Replacing extraction worker %s', worker.process.pid)
+        worker.kill(reading)
+        self._workers.discard(worker)
+        if self._idle is not None:
+            self._spawn()
+
+
+async def iter_playlist(pool, url, *, page_size=50, first_page=None):
+    """Yields the flat entries of a playlist, extracting one page at a time as they're consumed."""
+    start = 1
+    page = first_page
+    while True:
+        if page is None:
+            page = await pool.extract_page(url, start, start + page_size - 1)
+        for entry in page.get('entries', ()):
+            if entry.get('url'):
+                yield entry
+        if page.get('count', 0) < page_size:
+            return
+        start += page_size
+        page = None
@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+from collections import deque
+
+from extraction import stream_expiry
+
+
+class TrackRecord:
+    """What a guild needs to remember about the track it's playing."""
+    __slots__ = ('title', 'url', 'duration', 'expires_at')
+
+    def __init__(self, title, url, duration=None, expires_at=None):
+        self.title = title
+        self.url = url
+        self.duration = duration
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(data.get('title'), data.get('url'), data.get('duration'), stream_expiry(data))
+
+
+class GuildState:
+    """Playback state of one guild, dropped as a whole once the bot leaves or goes idle there."""
+    __slots__ = ('guild_id', 'queue', 'now_playing', 'last_active')
+
+    def __init__(self, guild_id, queue):
+        self.guild_id = guild_id
+        self.queue = queue
+        self.now_playing = None
+        self.last_active = time.monotonic()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def idle_for(self):
+        return time.monotonic() - self.last_active
+
+    def release(self):
+        self.queue.clear()
+        if self.queue.current is not None:
+            self.queue.current.cancel()
+            self.queue.current = None
+        self.now_playing = None
+
+    def memory_usage(self):
+        """Approximate bytes held by this guild's state and queue."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.queue) + sys.getsizeof(self.queue.entries)
+        if self.now_playing is not None:
+            size += deep_sizeof(self.now_playing)
+        tracks = list(self.queue.entries)
+        if self.queue.current is not None:
+            tracks.append(self.queue.current)
+        for track in tracks:
+            size += deep_sizeof(track)
+        return size
+
+
+def deep_sizeof(obj, seen=None):
+    """``sys.getsizeof`` of ``obj`` plus its containers and slotted attributes, each object counted once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    else:
+        for name in getattr(type(obj), '__slots__', ()):
+            value = getattr(obj, name, None)
+            # Open sources and tasks belong to the audio machinery, not the state
+            if isinstance(value, (str, bytes, int, float, dict, list, tuple)) or value is None:
+                size += deep_sizeof(value, seen)
+    return size
+
+
+def process_rss():
+    """Returns the resident set size of this process in bytes, ``None`` if it can't be read."""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current RSS, in bytes on macOS and KiB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,152 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+import discord
+
+from metrics import LOG_DROPPED
+
+TEXT_FORMAT = '[{asctime}] [{levelname:<8}] {name}: {message}'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_rates(spec):
+    """Parses ``'discord.gateway=10,discord.http=0.5'`` into ``{'discord.gateway': 10.0, 'discord.http': 0.5}``."""
+    rates = {}
+    for item in (spec or '').split(','):
+        name, _, value = item.strip().partition('=')
+        if name and value:
+            rates[name] = float(value)
+    return rates
+
+
+class RecordLimiter(logging.Filter):
+    """Thins out debug and info records of busy loggers before they're queued.
+
+    ``rate_limits`` caps the records per second of a logger (and its children)
+    with a token bucket allowing a one second burst; ``sample_rates`` keeps only
+    that share of its records. The most specific configured name wins.
+    Warnings and errors are always let through.
+    """
+
+    def __init__(self, rate_limits=None, sample_rates=None):
+        super().__init__()
+        self.rate_limits = rate_limits or {}
+        self.sample_rates = sample_rates or {}
+        self._rules = {}  # logger name -> configured name it falls under, or None
+        self._buckets = {name: [rate, time.monotonic()] for name, rate in self.rate_limits.items()}
+        self._lock = threading.Lock()
+
+    def rule(self, name):
+        try:
+            return self._rules[name]
+        except KeyError:
+            pass
+        rule = None
+        for configured in (*self.rate_limits, *self.sample_rates):
+            if (name == configured or name.startswith(configured + '.')) and len(configured) > len(rule or ''):
+                rule = configured
+        self._rules[name] = rule
+        return rule
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rule = self.rule(record.name)
+        if rule is None:
+            return True
+        sample = self.sample_rates.get(rule)
+        if sample is not None and random.random() >= sample:
+            LOG_DROPPED.labels(rule, 'sampled').inc()
+            return False
+        rate = self.rate_limits.get(rule)
+        if rate is None:
+            return True
+        with self._lock:
+            bucket = self._buckets[rule]
+            now = time.monotonic()
+            tokens = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                allowed = False
+            else:
+                bucket[0] = tokens - 1
+                allowed = True
+        if not allowed:
+            LOG_DROPPED.labels(rule, 'rate_limited').inc()
+        return allowed
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, with ``fields`` added to each."""
+
+    def __init__(self, fields=None):
+        super().__init__()
+        self.fields = fields or {}
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+            **self.fields,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, so formatting happens on the listener thread, and never blocks when full."""
+
+    def prepare(self, record):
+        # Args are formatted later on; the standard handler formats here, in the logging thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.labels(record.name, 'queue_full').inc()
+
+
+def setup_logging(level=logging.INFO, *, json_output=False, fields=None, rate_limits=None, sample_rates=None,
+                  max_queue=10000, stream=None):
+    """Routes every log record through a queue to a thread that formats and writes it.
+
+    The logging call only builds the record and puts it in the queue, so
+    neither the event loop nor the audio threads wait on formatting or on the
+    terminal. Returns the started :class:`logging.handlers.QueueListener`; it's
+    stopped (and the queue flushed) at exit.
+    """
+    handler = logging.StreamHandler(stream)
+    if json_output:
+        handler.setFormatter(JsonFormatter(fields))
+    elif discord.utils.stream_supports_colour(handler.stream):
+        handler.setFormatter(discord.utils._ColourFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT, style='{'))
+
+    records = queue.Queue(max_queue)
+    queue_handler = BackgroundQueueHandler(records)
+    if rate_limits or sample_rates:
+        queue_handler.addFilter(RecordLimiter(rate_limits, sample_rates))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from metrics import LOOP_BLOCKED, LOOP_LAG
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Stall:
+    """A callback that held the event loop for at least the watchdog's threshold."""
+    __slots__ = ('started', 'duration', 'stack')
+
+    def __init__(self, started, duration, stack):
+        self.started = started
+        self.duration = duration
+        self.stack = stack
+
+
+class LoopWatchdog:
+    """Samples the lag of the running event loop and catches callbacks that block it.
+
+    A task on the loop sleeps ``interval`` seconds at a time and records how
+    late it wakes up. A monitor thread watches the task's heartbeat; once the
+    loop has been stuck for ``threshold`` seconds it grabs the loop thread's
+    stack, which points at whatever is blocking, and logs it. The last
+    ``max_stalls`` of those are kept in :attr:`stalls`.
+    """
+
+    def __init__(self, *, interval=0.1, threshold=0.25, window=3000, max_stalls=50):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=window)
+        self.stalls = deque(maxlen=max_stalls)
+        self._beat = None
+        self._reported = None
+        self._loop_thread = None
+        self._task = None
+        self._finished = threading.Event()
+
+    def start(self):
+        """Starts sampling the running loop."""
+        self._loop_thread = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def close(self):
+        self._finished.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def snapshot(self, *, reset=False):
+        """Returns the lag samples kept so far and their percentiles, in seconds."""
+        lags = list(self.lags)
+        if reset:
+            self.lags.clear()
+        return {
+            'lags': lags,
+            'p50': percentile(lags, 0.5),
+            'p99': percentile(lags, 0.99),
+            'max': max(lags, default=None),
+        }
+
+    async def _sample(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - expected)
+            self._beat = now
+            self.lags.append(lag)
+            LOOP_LAG.observe(lag)
+            stall = self.stalls[-1] if self.stalls else None
+            if stall is not None and stall.duration is None:
+                # The loop got going again, now the stall's full length is known
+                stall.duration = lag
+
+    def _watch(self):
+        while not self._finished.wait(self.interval / 2):
+            beat = self._beat
+            blocked = time.perf_counter() - beat - self.interval
+            if blocked < self.threshold or beat == self._reported:
+                continue
+            self._reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            self.stalls.append(Stall(time.time() - blocked, None, stack))
+            LOOP_BLOCKED.inc()
+            logger.warning('Event loop blocked for %.0f ms so far, in:\n%s', blocked * 1000, stack.rstrip())
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import re
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DURATION = re.compile(rb'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+INTEGRATED = re.compile(rb'I:\s+(-?(?:\d+(?:\.\d+)?|inf)) LUFS')
+TRUE_PEAK = re.compile(rb'Peak:\s+(-?(?:\d+(?:\.\d+)?|inf)) dBFS')
+# EBU R128 gates everything below this, quieter readings mean "silent"
+FLOOR = -70.0
+
+
+class Loudness:
+    """EBU R128 integrated loudness (LUFS) and true peak (dBTP) of a piece of audio."""
+    __slots__ = ('integrated', 'true_peak')
+
+    def __init__(self, integrated, true_peak):
+        self.integrated = max(integrated, FLOOR)
+        self.true_peak = max(true_peak, FLOOR)
+
+    def gain(self, target=-20.0, max_peak=-1.0, tolerance=0.0):
+        """Returns the linear gain bringing this audio to ``target`` LUFS.
+
+        The gain is capped so the true peak stays under ``max_peak``, and
+        is exactly 1.0 when less than ``tolerance`` dB away from it.
+        """
+        if self.integrated <= FLOOR:
+            return 1.0
+        gain_db = min(target - self.integrated, max_peak - self.true_peak)
+        if abs(gain_db) < tolerance:
+            return 1.0
+        return 10 ** (gain_db / 20)
+
+    def to_row(self):
+        return [self.integrated, self.true_peak]
+
+
+def analyze(path, executable='ffmpeg', timeout=60):
+    """Blocking: decodes the local file ``path`` once and returns ``(duration, loudness)``.
+
+    Either can be ``None`` when ffmpeg couldn't tell.
+    """
+    result = subprocess.run(
+        [executable, '-hide_banner', '-nostdin', '-nostats', '-i', str(path),
+         '-vn', '-af', 'ebur128=peak=true:framelog=quiet', '-f', 'null', '-'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout,
+    )
+
+    duration = None
+    match = DURATION.search(result.stderr)
+    if match:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    loudness = None
+    # The summary comes last, after the per-filter log lines
+    integrated = INTEGRATED.findall(result.stderr)
+    peak = TRUE_PEAK.findall(result.stderr)
+    if result.returncode == 0 and integrated and peak:
+        loudness = Loudness(float(integrated[-1]), float(peak[-1]))
+    return duration, loudness
+
+
+class LoudnessStore:
+    """Loudness of tracks, measured once in the background and kept on disk.
+
+    Keys are normalized track URLs. Measuring means decoding the whole track
+    through ffmpeg, so it runs on a single thread, one track at a time, and
+    each track is only ever measured once. Only local files are measured
+    (media cache and music library tracks): fetching a stream a second time
+    would double its bandwidth, and its signed URL may well expire while it
+    waits for its turn. At most ``max_pending`` measurements wait at once.
+    """
+
+    def __init__(self, path, *, max_entries=5000, max_duration=1200, max_pending=16, executable='ffmpeg'):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_duration = max_duration
+        self.max_pending = max_pending
+        self.executable = executable
+        self._entries = OrderedDict()
+        self._pending = set()
+        self._executor = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def measure(self, key, data):
+        """Schedules a measurement of the local track in ``data`` unless it's known or too long.
+
+        Can be called from any thread. Returns a :class:`concurrent.futures.Future`, if anything was scheduled.
+        """
+        if not data.get('local') or key in self._entries or key in self._pending:
+            return None
+        if not data.get('url') or (data.get('duration') or 0) > self.max_duration:
+            return None
+        if len(self._pending) >= self.max_pending:
+            logger.debug('Not measuring %s, %d measurements are already waiting', key, len(self._pending))
+            return None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='loudness')
+        self._pending.add(key)
+        future = self._executor.submit(self._measure, key, data['url'])
+        future.add_done_callback(lambda _: self._pending.discard(key))
+        return future
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as fp:
+                rows = json.load(fp)
+            self._entries = OrderedDict((key, Loudness(*row)) for key, row in rows.items())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.warning('Ignoring unreadable loudness store %s: %s', self.path, e)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        rows = {key: loudness.to_row() for key, loudness in list(self._entries.items())}
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(rows, fp, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _measure(self, key, path):
+        try:
+            _, loudness = analyze(path, self.executable, timeout=max(60, self.max_duration))
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning('Could not measure the loudness of %s: %s', key, e)
+            return None
+        if loudness is None:
+            logger.debug('No loudness reading for %s', key)
+            return None
+        self._entries[key] = loudness
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning('Could not save the loudness store %s: %s', self.path, e)
+        logger.debug('Measured %s at %.1f LUFS, %.1f dBTP', key, loudness.integrated, loudness.true_peak)
+        return loudness
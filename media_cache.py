@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import discord
+from discord.oggparse import OggStream
+
+from extraction import normalize_url
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+UNSAFE = re.compile(r'[^\w.-]+')
+# Kept so tracks can be queued and shown without extracting them again
+CACHED_FIELDS = ('id', 'extractor', 'title', 'webpage_url', 'duration', 'abr')
+
+
+def track_id(data):
+    """Returns the file name stem of a track: its extractor and id."""
+    return UNSAFE.sub('_', f'{data.get("extractor") or "generic"}-{data["id"]}')
+
+
+class CachedTrack:
+    __slots__ = ('key', 'info', 'size', 'plays', 'last_played', 'aliases')
+
+    def __init__(self, key, info, size=0, plays=0, last_played=0.0, aliases=()):
+        self.key = key
+        self.info = info
+        self.size = size
+        self.plays = plays
+        self.last_played = last_played
+        self.aliases = set(aliases)
+
+    def to_row(self):
+        return [self.info, self.size, self.plays, self.last_played, sorted(self.aliases)]
+
+
+class CachedTrackAudio(discord.AudioSource):
+    """Plays an Ogg Opus file from the media cache, straight from disk and without ffmpeg."""
+
+    def __init__(self, path, data, *, gain=1.0):
+        self.data = data
+        self.title = data.get('title')
+        self.url = path
+        self.gain = gain
+        self._file = open(path, 'rb')
+        self._packets = OggStream(self._file).iter_packets()
+
+    def read(self):
+        for packet in self._packets:
+            if not packet.startswith((b'OpusHead', b'OpusTags')):
+                return packet
+        return b''
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class MediaCache:
+    """Disk cache of often played tracks, transcoded to Ogg Opus and named by extractor and id.
+
+    Every play is counted; once a track reaches ``min_plays`` it is copied
+    (or transcoded, if it isn't opus already) from its stream URL in the
+    background, one track at a time. Files are written to a temporary name and
+    renamed into place, and the index is rewritten the same way, so a crash
+    never leaves a half-written track behind. The least recently played
+    tracks are evicted once the cache grows past ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir, *, max_bytes=2 * 1024 ** 3, min_plays=3, max_duration=1200,
+                 max_counted=5000, executable='ffmpeg', before_options=None, on_cached=None):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration
+        self.max_counted = max_counted
+        self.hits = 0
+        self.misses = 0
+        self.executable = executable
+        self.before_options = before_options
+        # Called from the cache's thread with the local info dict of each newly cached track
+        self.on_cached = on_cached
+        self.tracks = {}  # key -> CachedTrack, only tracks that are on disk
+        self.counts = OrderedDict()  # key -> plays, for tracks that aren't cached yet
+        self._aliases = {}  # normalized URL -> key
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+
+    @property
+    def disk_usage(self):
+        return self._bytes
+
+    @property
+    def index_path(self):
+        return self.cache_dir / 'index.json'
+
+    def path_for(self, key):
+        return self.cache_dir / f'{key}.opus'
+
+    def lookup(self, query, *, peek=False):
+        """Returns the info dict of a cached track for ``query``, with ``url`` pointing at the local file.
+
+        Only lookups that decide what plays count towards the hit ratio, ``peek`` ones don't.
+        """
+        with self._lock:
+            track = self.tracks.get(self._aliases.get(normalize_url(query)))
+            if not peek:
+                if track is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return self._local_info(track) if track is not None else None
+
+    def _local_info(self, track):
+        return {**track.info, 'url': str(self.path_for(track.key)), 'acodec': 'opus', 'local': True}
+
+    def source(self, data, *, gain=1.0):
+        return CachedTrackAudio(data['url'], data, gain=gain)
+
+    def record_play(self, query, data):
+        """Counts a play of the track in ``data``, queued as ``query``, and caches it once it's popular enough."""
+        if data.get('is_live') or not data.get('id'):
+            return
+        key = track_id(data)
+        aliases = {normalize_url(query)}
+        if data.get('webpage_url'):
+            aliases.add(normalize_url(data['webpage_url']))
+        # Search results can change, only links are worth remembering
+        aliases = {alias for alias in aliases if not alias.startswith('search:')}
+
+        with self._lock:
+            track = self.tracks.get(key)
+            if track is not None:
+                track.plays += 1
+                track.last_played = time.time()
+                for alias in aliases - track.aliases:
+                    track.aliases.add(alias)
+                    self._aliases[alias] = key
+                return
+            plays = self.counts.pop(key, 0) + 1
+            self.counts[key] = plays
+            while len(self.counts) > self.max_counted:
+                self.counts.popitem(last=False)
+
+        if plays >= self.min_plays and not data.get('local'):
+            self.populate(key, data, aliases)
+
+    def populate(self, key, data, aliases=()):
+        """Schedules ``data`` to be fetched into the cache in the background. Returns the future, if any."""
+        if key in self._pending or (data.get('duration') or 0) > self.max_duration:
+            return None
+        with self._lock:
+            track = self.tracks.get(key)
+            if track is not None:
+                # Already on disk, only the new ways to refer to it are worth keeping
+                for alias in set(aliases) - track.aliases:
+                    track.aliases.add(alias)
+                    self._aliases[alias] = key
+                return None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='media-cache')
+        self._pending.add(key)
+        future = self._executor.submit(self._fetch, key, data, set(aliases))
+        future.add_done_callback(lambda _: self._pending.discard(key))
+        return future
+
+    def load(self):
+        """Blocking: reads the index and reconciles it with the files actually on disk."""
+        try:
+            with open(self.index_path, encoding='utf-8') as fp:
+                data = json.load(fp)
+            if data.get('version') != INDEX_VERSION:
+                raise ValueError(f'unsupported index version {data.get("version")}')
+            tracks = {key: CachedTrack(key, *row) for key, row in data['tracks'].items()}
+            counts = OrderedDict(data.get('counts', ()))
+        except FileNotFoundError:
+            tracks, counts = {}, OrderedDict()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('Ignoring unreadable media cache index %s: %s', self.index_path, e)
+            tracks, counts = {}, OrderedDict()
+
+        on_disk = {}
+        if self.cache_dir.is_dir():
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.tmp'):
+                    # Left behind by a fetch that never finished
+                    os.unlink(entry.path)
+                elif entry.name.endswith('.opus'):
+                    on_disk[entry.name[:-len('.opus')]] = entry.stat().st_size
+        for key in on_disk.keys() - tracks.keys():
+            logger.info('Removing untracked media cache file %s', key)
+            self.path_for(key).unlink(missing_ok=True)
+
+        with self._lock:
+            self.tracks = {key: track for key, track in tracks.items() if key in on_disk}
+            for key, track in self.tracks.items():
+                track.size = on_disk[key]
+            self.counts = counts
+            self._aliases = {alias: key for key, track in self.tracks.items() for alias in track.aliases}
+            self._bytes = sum(track.size for track in self.tracks.values())
+
+    def save(self):
+        with self._lock:
+            data = {
+                'version': INDEX_VERSION,
+                'tracks': {key: track.to_row() for key, track in self.tracks.items()},
+                'counts': list(self.counts.items()),
+            }
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(data, fp, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, self.index_path)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning('Could not save the media cache index: %s', e)
+
+    def _fetch(self, key, data, aliases):
+        path = self.path_for(key)
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        args = [self.executable, '-nostdin', '-loglevel', 'error']
+        if self.before_options:
+            args.extend(shlex.split(self.before_options))
+        args.extend(['-i', data['url'], '-vn', '-map_metadata', '-1'])
+        if data.get('acodec') == 'opus':
+            args.extend(['-c:a', 'copy'])
+        else:
+            args.extend(['-c:a', 'libopus', '-b:a', '128k', '-ar', '48000', '-ac', '2'])
+        args.extend(['-f', 'opus', str(tmp)])
+
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=self.max_duration)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.decode(errors='replace').strip())
+            with open(tmp, 'rb') as fp:
+                os.fsync(fp.fileno())
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning('Could not cache %s: %s', key, e)
+            tmp.unlink(missing_ok=True)
+            return None
+
+        track = CachedTrack(
+            key, {field: data[field] for field in CACHED_FIELDS if data.get(field) is not None},
+            size=path.stat().st_size, last_played=time.time(), aliases=aliases,
+        )
+        with self._lock:
+            track.plays = self.counts.pop(key, 0)
+            previous = self.tracks.get(key)
+            if previous is not None:
+                # Replaced by the fresh copy, which is known by the old aliases too
+                self._bytes -= previous.size
+                track.plays += previous.plays
+                track.aliases |= previous.aliases
+            self.tracks[key] = track
+            self._bytes += track.size
+            aliases = track.aliases
+            for alias in aliases:
+                self._aliases[alias] = key
+            evicted = self._evict()
+        for old in evicted:
+            self.path_for(old.key).unlink(missing_ok=True)
+            logger.debug('Evicted %s from the media cache', old.key)
+        self.save()
+        logger.info('Cached %s (%d KiB)', key, track.size // 1024)
+        if self.on_cached is not None:
+            self.on_cached(self._local_info(track))
+        return track
+
+    def _evict(self):
+        """Drops the least recently played tracks until the cache fits. Call with the lock held."""
+        evicted = []
+        by_age = sorted(self.tracks.values(), key=lambda track: track.last_played)
+        while self._bytes > self.max_bytes and len(by_age) > 1:
+            track = by_age.pop(0)
+            del self.tracks[track.key]
+            for alias in track.aliases:
+                if self._aliases.get(alias) == track.key:
+                    del self._aliases[alias]
+            self._bytes -= track.size
+            evicted.append(track)
+        return evicted
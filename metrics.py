@@ -0,0 +1,259 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a few frames up to a slow extraction
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+JITTER_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+ENCODE_BUCKETS = (0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(list(self._children.items()), key=lambda item: item[0]):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f'{self.name}{_labels(self.labelnames, values)} {child.value}']
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def _render_child(self, values, child):
+        return [f'{self.name}{_labels(self.labelnames, values)} {child.value}']
+
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        total = 0
+        for bound, count in zip((*self.buckets, '+Inf'), child.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, values, [("le", bound)])} {total}')
+        lines.append(f'{self.name}_sum{_labels(self.labelnames, values)} {child.sum}')
+        lines.append(f'{self.name}_count{_labels(self.labelnames, values)} {total}')
+        return lines
+
+
+REGISTRY = []
+# Called right before each scrape, on an executor thread, to refresh gauges read from elsewhere
+COLLECTORS = []
+
+FIRST_AUDIO = Histogram(
+    'somalezu_first_audio_seconds', 'Time from an interaction to its first audio frame.', ['command'],
+)
+EXTRACTION = Histogram(
+    'somalezu_extraction_seconds', 'Time spent in an extraction worker per job.', ['op'],
+)
+SOURCE_STARTUP = Histogram(
+    'somalezu_source_startup_seconds', 'Time from opening an audio source to its first frame.', ['backend'],
+)
+FRAME_JITTER = Histogram(
+    'somalezu_frame_jitter_seconds', 'Deviation of the interval between sent frames from 20 ms.',
+    buckets=JITTER_BUCKETS,
+)
+LATE_FRAMES = Counter('somalezu_late_frames_total', 'Frames sent more than one frame interval late.')
+SUBPROCESSES = Gauge('somalezu_subprocesses', 'Live child processes of the bot.', ['name'])
+CACHE_HITS = Counter('somalezu_cache_hits_total', 'Cache lookups that were served from the cache.', ['cache'])
+CACHE_MISSES = Counter('somalezu_cache_misses_total', 'Cache lookups that missed.', ['cache'])
+CACHE_HIT_RATIO = Gauge('somalezu_cache_hit_ratio', 'Share of cache lookups served from the cache.', ['cache'])
+LOOP_LAG = Histogram(
+    'somalezu_loop_lag_seconds', 'How late the event loop ran a timer it was given.', buckets=LAG_BUCKETS,
+)
+LOOP_BLOCKED = Counter('somalezu_loop_blocked_total', 'Times a callback blocked the event loop past the threshold.')
+LOG_DROPPED = Counter(
+    'somalezu_log_records_dropped_total', 'Log records dropped before being written.', ['logger', 'reason'],
+)
+OPUS_ENCODE = Histogram(
+    'somalezu_opus_encode_seconds', 'Time spent encoding one 20 ms frame to opus.', ['signal'],
+    buckets=ENCODE_BUCKETS,
+)
+OPUS_COMPLEXITY = Counter(
+    'somalezu_opus_complexity_changes_total', 'Times an encoder lowered or raised its complexity.', ['direction'],
+)
+
+
+def observe_since(histogram, started, *labels):
+    """Returns a callback observing the time since ``started`` (a ``perf_counter`` value) once."""
+    done = False
+
+    def observe(*_):
+        nonlocal done
+        if not done:
+            done = True
+            histogram.labels(*labels).observe(time.perf_counter() - started)
+    return observe
+
+
+def track_cache(name, cache):
+    """Exports the ``hits`` and ``misses`` counters of ``cache`` under ``name`` at every scrape."""
+    def collect():
+        hits, misses = cache.hits, cache.misses
+        CACHE_HITS.labels(name).set(hits)
+        CACHE_MISSES.labels(name).set(misses)
+        CACHE_HIT_RATIO.labels(name).set(hits / (hits + misses) if hits + misses else 0.0)
+    COLLECTORS.append(collect)
+
+
+def child_processes():
+    """Counts this process's live children by executable name (Linux only, empty elsewhere)."""
+    counts = {}
+    pid = str(os.getpid())
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return counts
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as fp:
+                stat = fp.read().decode(errors='replace')
+        except OSError:
+            continue
+        # The name is in parentheses and may itself contain spaces
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        if stat[stat.rindex(')') + 2:].split()[1] == pid:
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def _collect_subprocesses():
+    counts = child_processes()
+    for values, child in list(SUBPROCESSES._children.items()):
+        child.set(counts.pop(values[0], 0))
+    for name, count in counts.items():
+        SUBPROCESSES.labels(name).set(count)
+
+
+COLLECTORS.append(_collect_subprocesses)
+
+
+def render():
+    for collect in COLLECTORS:
+        try:
+            collect()
+        except Exception:
+            logger.exception('Metrics collector failed')
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def start_server(host, port):
+    """Serves ``/metrics`` in the Prometheus text format on the running event loop.
+
+    Scrapes are rendered on the default executor, the collectors' ``/proc``
+    scan is blocking file IO that would otherwise stall the loop.
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        text = await asyncio.get_running_loop().run_in_executor(None, render)
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info('Serving metrics on http://%s:%d/metrics', host, port)
+    return runner
@@ -0,0 +1,225 @@
+import audioop
+import logging
+import threading
+import time
+
+import discord
+
+from metrics import FRAME_JITTER, LATE_FRAMES
+
+logger = logging.getLogger(__name__)
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+SILENCE = bytes(FRAME_SIZE)
+FRAME_INTERVAL = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+class MixerLayer:
+    """A single source inside a :class:`MixerSource`, with its own volume.
+
+    ``on_start`` is called from the audio thread once the source produced its
+    first frame, or for sources with a ``started`` attribute, once that's set.
+    Opus packets longer than 20 ms decode to several frames, the rest is kept
+    and returned by the next reads.
+    """
+    __slots__ = ('source', 'volume', 'after', 'on_start', '_decoder', '_pending')
+
+    def __init__(self, source, *, volume=1.0, after=None, on_start=None):
+        self.source = source
+        self.volume = volume
+        self.after = after
+        self.on_start = on_start
+        self._decoder = None
+        self._pending = b''
+
+    def read(self, *, decode=True):
+        if decode and self._pending:
+            data, self._pending = self._pending[:FRAME_SIZE], self._pending[FRAME_SIZE:]
+            return self._finish_frame(data)
+        data = self.source.read()
+        if not data:
+            return b''
+        if self.on_start is not None and getattr(self.source, 'started', True):
+            on_start, self.on_start = self.on_start, None
+            try:
+                on_start()
+            except Exception:
+                logger.exception('Mixer layer start callback failed')
+        if not decode:
+            # Passed through as-is, so a later decode has to start from a clean state
+            self._decoder = None
+            self._pending = b''
+            return data
+        if self.source.is_opus():
+            # Cached clips are stored as opus, decode them in-process to mix
+            if self._decoder is None:
+                self._decoder = discord.opus.Decoder()
+            data = self._decoder.decode(data)
+            if len(data) > FRAME_SIZE:
+                # Mixing takes exactly one frame, audioop.add raises on anything longer
+                data, self._pending = data[:FRAME_SIZE], data[FRAME_SIZE:]
+        return self._finish_frame(data)
+
+    def _finish_frame(self, data):
+        if len(data) < FRAME_SIZE:
+            data += bytes(FRAME_SIZE - len(data))
+        if self.volume != 1.0:
+            data = audioop.mul(data, 2, self.volume)
+        return data
+
+    def finish(self, error=None):
+        try:
+            self.source.cleanup()
+        finally:
+            if self.after is not None:
+                try:
+                    self.after(error)
+                except Exception:
+                    logger.exception('Mixer layer after callback failed')
+
+
+class MixerSource(discord.AudioSource):
+    """Sums a music stream and any number of clips into one PCM stream.
+
+    Clips are overlaid on the music frame by frame with saturating int16
+    addition, so pressing a soundboard button never pauses or restarts the
+    music pipeline. At most ``max_voices`` clips play at once; the oldest clip
+    is dropped when a new one would exceed the cap.
+
+    While an opus source at full volume is the only thing playing, its packets
+    are passed through untouched and :meth:`is_opus` reports ``True`` for that
+    frame; it's only decoded once something has to be mixed with it. Until
+    the first read it reports ``True`` as well, so ``VoiceClient.play()``
+    doesn't replace the encoder set up for the mixer with a default one.
+
+    The mixer ends (``read`` returns ``b''``) once it has no layers left, after
+    which :attr:`closed` is set and a new mixer has to be started.
+    """
+
+    def __init__(self, *, max_voices=8):
+        self.max_voices = max_voices
+        self.music = None
+        self.music_paused = False
+        self.clips = []
+        self.closed = False
+        self._opus = True
+        self._last_read = None
+        self._lock = threading.Lock()
+
+    def set_music(self, source, *, volume=1.0, after=None, on_start=None):
+        """Replaces the music layer. Returns ``False`` if the mixer already ended."""
+        layer = MixerLayer(source, volume=volume, after=after, on_start=on_start)
+        with self._lock:
+            if self.closed:
+                return False
+            previous, self.music = self.music, layer
+            self.music_paused = False
+        if previous is not None:
+            previous.finish()
+        return True
+
+    def stop_music(self):
+        with self._lock:
+            previous, self.music = self.music, None
+        if previous is not None:
+            previous.finish()
+
+    def pause_music(self):
+        self.music_paused = True
+
+    def resume_music(self):
+        self.music_paused = False
+
+    @property
+    def playing_music(self):
+        return self.music is not None and not self.music_paused
+
+    @property
+    def music_source(self):
+        music = self.music
+        return music.source if music is not None else None
+
+    def set_music_volume(self, volume):
+        music = self.music
+        if music is not None:
+            music.volume = volume
+
+    def add_clip(self, source, *, volume=1.0, after=None, on_start=None):
+        """Overlays ``source`` on the current output. Returns ``False`` if the mixer already ended."""
+        dropped = []
+        with self._lock:
+            if self.closed:
+                return False
+            self.clips.append(MixerLayer(source, volume=volume, after=after, on_start=on_start))
+            while len(self.clips) > self.max_voices:
+                dropped.append(self.clips.pop(0))
+        for layer in dropped:
+            layer.finish()
+        return True
+
+    def read(self):
+        # The audio player reads right before sending, so read intervals are send intervals
+        now = time.perf_counter()
+        # Gaps of a second or more are the player being paused, not late frames
+        if self._last_read is not None and now - self._last_read < 1.0:
+            interval = now - self._last_read
+            FRAME_JITTER.observe(abs(interval - FRAME_INTERVAL))
+            if interval > 2 * FRAME_INTERVAL:
+                LATE_FRAMES.inc()
+        self._last_read = now
+
+        with self._lock:
+            music = None if self.music_paused else self.music
+            layers = [music, *self.clips] if music is not None else list(self.clips)
+
+        if len(layers) == 1 and layers[0].volume == 1.0 and layers[0].source.is_opus():
+            data = self._read_layer(layers[0], decode=False)
+            if data:
+                self._opus = True
+                return data
+            layers = []
+        self._opus = False
+
+        # A lone PCM layer at full volume is returned as-is, without extra copies
+        mixed = None
+        for layer in layers:
+            data = self._read_layer(layer)
+            if data:
+                mixed = data if mixed is None else audioop.add(mixed, data, 2)
+
+        if mixed is not None:
+            return mixed
+        with self._lock:
+            if self.music is None and not self.clips:
+                self.closed = True
+                return b''
+        return SILENCE
+
+    def _read_layer(self, layer, *, decode=True):
+        error = None
+        try:
+            data = layer.read(decode=decode)
+        except Exception as e:
+            logger.exception('Mixer layer failed')
+            data, error = b'', e
+        if not data:
+            with self._lock:
+                if layer is self.music:
+                    self.music = None
+                elif layer in self.clips:
+                    self.clips.remove(layer)
+            layer.finish(error)
+        return data
+
+    def is_opus(self):
+        # Asked by the audio player right after each read
+        return self._opus
+
+    def cleanup(self):
+        with self._lock:
+            self.closed = True
+            layers = [self.music, *self.clips] if self.music is not None else list(self.clips)
+            self.music = None
+            self.clips = []
+        for layer in layers:
+            layer.finish()
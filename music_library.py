@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+import re
+import subprocess
+from functools import cached_property
+from pathlib import Path
+
+from loudness import DURATION
+from sound_search import SoundSearch, tokenize
+
+try:
+    import av
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+SUPPORTED_EXTS = {'.mp3', '.wav', '.ogg', '.opus', '.flac', '.m4a', '.aac', '.wma', '.aiff'}
+TAG_FIELDS = ('title', 'artist', 'album', 'genre')
+# Lines like "    artist          : Queen" under the Metadata sections of ffmpeg's input summary
+METADATA_LINE = re.compile(rb'^\s+(title|artist|album|genre)\s*: (.*)$', re.IGNORECASE | re.MULTILINE)
+CODEC = re.compile(rb'Audio: (\w+)')
+# Prefixed to library paths wherever a track is referred to like a URL
+SCHEME = 'library:'
+OGG_EXTS = ('.opus', '.ogg')
+# Discord takes 20 ms opus packets, files packed otherwise have to be re-encoded
+PASSTHROUGH_PACKET_MS = 20
+
+
+class LibraryTrack:
+    __slots__ = ('name', 'path', 'title', 'artist', 'album', 'genre', 'duration', 'codec', 'size', 'mtime_ns',
+                 'packet_ms')
+
+    def __init__(self, name, path, title, artist, album, genre, duration, codec, size, mtime_ns, packet_ms=None):
+        self.name = name
+        self.path = path
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.genre = genre
+        self.duration = duration
+        self.codec = codec
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.packet_ms = packet_ms
+
+    @property
+    def key(self):
+        return SCHEME + self.name
+
+    @property
+    def label(self):
+        title = self.title or Path(self.name).stem
+        return f'{self.artist} - {title}' if self.artist else title
+
+    @property
+    def tags(self):
+        return tuple(word for field in TAG_FIELDS for word in tokenize(getattr(self, field) or ''))
+
+    @property
+    def passthrough(self):
+        """Whether the file's opus packets can be sent as they are, which takes Ogg Opus in 20 ms packets."""
+        return self.codec == 'opus' and self.packet_ms == PASSTHROUGH_PACKET_MS
+
+    def data(self):
+        """Returns an info dict to play the track from, like an extracted one."""
+        return {
+            'title': self.label,
+            'url': self.path,
+            'webpage_url': self.key,
+            'extractor': 'library',
+            'duration': self.duration,
+            # Passed-through files are played like the media cache's, other opus is decoded like any format
+            'acodec': self.codec if self.passthrough or self.codec != 'opus' else None,
+            'local': True,
+        }
+
+    def to_row(self):
+        return [self.name, self.title, self.artist, self.album, self.genre, self.duration, self.codec,
+                self.size, self.mtime_ns, self.packet_ms]
+
+
+class MusicLibrary:
+    """Read-only index of the audio files under a directory, searchable by tags and path.
+
+    Built by :func:`scan`, which only probes files that are new or changed
+    since the previous index, and swapped in whole like the sound index.
+    """
+
+    def __init__(self, root, tracks):
+        self.root = Path(root)
+        self.tracks = tracks
+        self.by_name = {track.name: track for track in tracks}
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    def get(self, key):
+        """Returns the track a ``library:`` key refers to."""
+        if not key.startswith(SCHEME):
+            return None
+        return self.by_name.get(key[len(SCHEME):])
+
+    @cached_property
+    def search(self):
+        return SoundSearch(self.tracks)
+
+    def matches(self, query, limit=25):
+        """Returns the tracks among the best ``limit`` results that every word of ``query`` starts a word of.
+
+        Unlike the soundboard's, fuzzy results don't count here: anything
+        that isn't clearly in the library is looked up online instead.
+        """
+        parts = tokenize(query)
+        if not parts:
+            return []
+        matches = []
+        for track in self.search.search(query, limit=limit):
+            words = set(tokenize(track.name.rsplit('.', 1)[0])) | set(track.tags)
+            if all(any(word.startswith(part) for word in words) for part in parts):
+                matches.append(track)
+        return matches
+
+    def match(self, query):
+        matches = self.matches(query, limit=5)
+        return matches[0] if matches else None
+
+    def rows(self):
+        return [track.to_row() for track in self.tracks]
+
+    @classmethod
+    def load(cls, root, index_path):
+        """Loads the index saved in ``index_path``, or an empty one if it's missing or unreadable."""
+        root = Path(root)
+        try:
+            with open(index_path, encoding='utf-8') as fp:
+                data = json.load(fp)
+            if data.get('version') != INDEX_VERSION:
+                raise ValueError(f'unsupported index version {data.get("version")}')
+            tracks = [LibraryTrack(row[0], str(root / row[0]), *row[1:]) for row in data['tracks']]
+        except FileNotFoundError:
+            tracks = []
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('Ignoring unreadable music library index %s: %s', index_path, e)
+            tracks = []
+        return cls(root, tracks)
+
+    def save(self, index_path):
+        index_path = Path(index_path)
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = index_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(
+                {'version': INDEX_VERSION, 'tracks': self.rows()},
+                fp, ensure_ascii=False, separators=(',', ':'),
+            )
+        os.replace(tmp, index_path)
+
+
+def probe(path, executable='ffmpeg'):
+    """Blocking: reads the tags, duration and codec of ``path`` without decoding it.
+
+    Returns ``(tags, duration, codec)``; PyAV opens the file in-process when
+    it's installed, ffmpeg's input summary is parsed otherwise.
+    """
+    tags = {}
+    if av is not None:
+        with av.open(path) as container:
+            stream = container.streams.audio[0] if container.streams.audio else None
+            # Ogg files keep their tags on the stream, most other containers on the file
+            for metadata in (container.metadata, stream.metadata if stream is not None else {}):
+                for name, value in metadata.items():
+                    name = name.lower()
+                    if name in TAG_FIELDS and value:
+                        tags.setdefault(name, value)
+            duration = container.duration / av.time_base if container.duration else None
+            codec = stream.codec_context.codec.canonical_name if stream is not None else None
+        return tags, duration, codec
+
+    result = subprocess.run(
+        [executable, '-hide_banner', '-nostdin', '-i', str(path)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=30,
+    )
+    for name, value in METADATA_LINE.findall(result.stderr):
+        tags.setdefault(name.decode().lower(), value.decode(errors='replace').strip())
+    duration = None
+    match = DURATION.search(result.stderr)
+    if match:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    match = CODEC.search(result.stderr)
+    codec = match.group(1).decode() if match else None
+    return tags, duration, codec
+
+
+def opus_packet_ms(packet):
+    """Returns the duration of an opus ``packet`` in ms, from its TOC byte (RFC 6716, section 3.1)."""
+    if not packet:
+        return None
+    config = packet[0] >> 3
+    if config < 12:
+        frame_ms = (10, 20, 40, 60)[config % 4]  # SILK
+    elif config < 16:
+        frame_ms = (10, 20)[config % 2]  # Hybrid
+    else:
+        frame_ms = (2.5, 5, 10, 20)[config % 4]  # CELT
+    code = packet[0] & 3
+    if code == 0:
+        return frame_ms
+    if code < 3:
+        return frame_ms * 2
+    # Code 3 packets carry their frame count in the next byte
+    return frame_ms * (packet[1] & 0x3F) if len(packet) > 1 else None
+
+
+def first_packet_ms(path):
+    """Blocking: returns the duration in ms of the first audio packet of the Ogg Opus file ``path``.
+
+    Only the Ogg pages are walked, nothing is decoded. Returns ``None`` if
+    the file holds no opus stream.
+    """
+    serial = None
+    index = 0  # of the packet being read; OpusHead and OpusTags come first
+    packet = b''
+    with open(path, 'rb') as fp:
+        while True:
+            header = fp.read(27)
+            if len(header) < 27 or header[:4] != b'OggS':
+                return None
+            lacing = fp.read(header[26])
+            body = fp.read(sum(lacing))
+            if serial is None and body.startswith(b'OpusHead'):
+                serial = header[14:18]
+            if header[14:18] != serial:
+                continue  # Another logical stream multiplexed into the file
+            offset = 0
+            for size in lacing:
+                if index == 2:
+                    packet += body[offset:offset + size]
+                offset += size
+                if size < 255:
+                    if index == 2:
+                        return opus_packet_ms(packet)
+                    index += 1
+
+
+def scan(root, previous=None, *, executable='ffmpeg'):
+    """Blocking: builds a fresh :class:`MusicLibrary` of every audio file under ``root``.
+
+    Files whose size and mtime match ``previous`` are reused as they are, so
+    a rescan of an unchanged tree only lists and stats it.
+    """
+    root = Path(root)
+    known = previous.by_name if previous is not None else {}
+    tracks = []
+    probed = 0
+
+    for directory, subdirs, files in os.walk(root):
+        subdirs.sort(key=str.lower)
+        for file_name in sorted(files, key=str.lower):
+            if Path(file_name).suffix.lower() not in SUPPORTED_EXTS:
+                continue
+            path = os.path.join(directory, file_name)
+            name = Path(path).relative_to(root).as_posix()
+            try:
+                stat = os.stat(path)
+                old = known.get(name)
+                if old is not None and (old.size, old.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                    tracks.append(old)
+                    continue
+                tags, duration, codec = probe(path, executable)
+                packet_ms = first_packet_ms(path) if codec == 'opus' and path.lower().endswith(OGG_EXTS) else None
+            except Exception as e:
+                logger.debug('Skipping unreadable library file %s: %s', path, e)
+                continue
+            probed += 1
+            tracks.append(LibraryTrack(
+                name, path, *(tags.get(field) for field in TAG_FIELDS), duration, codec,
+                stat.st_size, stat.st_mtime_ns, packet_ms,
+            ))
+
+    if probed:
+        logger.info('Indexed %d new or changed files in %s', probed, root)
+    return MusicLibrary(root, tracks)
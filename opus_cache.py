@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import struct
+import subprocess
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import discord
+from discord.oggparse import OggStream
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAGIC = b'SOMOPUS1'
+FRAME_HEADER = struct.Struct('<H')
+
+# Trim leading silence and encode straight to 20 ms Opus packets in an Ogg container
+ENCODE_ARGS = [
+    '-af', 'silenceremove=start_periods=1:start_threshold=-50dB',
+    '-map_metadata', '-1',
+    '-c:a', 'libopus',
+    '-ar', '48000',
+    '-ac', '2',
+    '-b:a', '96k',
+    '-frame_duration', '20',
+    '-application', 'audio',
+    '-f', 'opus',
+]
+
+
+def file_digest(path):
+    """Returns the sha1 of a file's content, used as its key in the disk cache."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class OpusClip:
+    """A clip decoded once into ready-to-send Opus packets."""
+    __slots__ = ('path', 'digest', 'frames', 'size')
+
+    def __init__(self, path, digest, frames):
+        self.path = path
+        self.digest = digest
+        self.frames = frames
+        self.size = sum(len(frame) for frame in frames)
+
+    @property
+    def duration(self):
+        return len(self.frames) * 0.02
+
+
+class CachedOpusAudio(discord.AudioSource):
+    """Plays an :class:`OpusClip` without spawning any subprocess."""
+
+    def __init__(self, clip):
+        self.clip = clip
+        self._frames = clip.frames
+        self._index = 0
+
+    def read(self):
+        if self._index >= len(self._frames):
+            return b''
+        frame = self._frames[self._index]
+        self._index += 1
+        return frame
+
+    def is_opus(self):
+        return True
+
+
+class OpusClipCache:
+    """Memory + disk cache of pre-encoded soundboard clips.
+
+    Clips are encoded with ffmpeg once, stored on disk under the sha1 of the
+    source file and kept in memory up to ``max_bytes`` with LRU eviction.
+    """
+
+    def __init__(self, cache_dir, *, max_bytes=64 * 1024 * 1024, executable='ffmpeg'):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.executable = executable
+        self.hits = 0
+        self.misses = 0
+        self._clips = OrderedDict()  # (path, mtime_ns, size) -> OpusClip
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pending = {}  # path -> asyncio.Future, so concurrent presses share one encode
+
+    @property
+    def memory_usage(self):
+        return self._bytes
+
+    async def get(self, path):
+        """Returns the :class:`OpusClip` for ``path``, encoding it on first use."""
+        path = str(path)
+        clip = self.get_cached(path)
+        if clip is not None:
+            return clip
+
+        future = self._pending.get(path)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = asyncio.ensure_future(loop.run_in_executor(None, self.load, path))
+            self._pending[path] = future
+            future.add_done_callback(lambda _: self._pending.pop(path, None))
+        return await asyncio.shield(future)
+
+    async def source(self, path):
+        return CachedOpusAudio(await self.get(path))
+
+    async def warm(self, paths):
+        """Encodes every clip in ``paths`` ahead of time, logging failures."""
+        for path in paths:
+            try:
+                await self.get(path)
+            except Exception as e:
+                logger.warning('Could not pre-encode %s: %s', path, e)
+
+    def get_cached(self, path):
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+        with self._lock:
+            clip = self._clips.get(key)
+            if clip is not None:
+                self._clips.move_to_end(key)
+                self.hits += 1
+            return clip
+
+    def load(self, path):
+        """Blocking: loads ``path`` from the disk cache or encodes it with ffmpeg."""
+        key = self._key(path)
+        with self._lock:
+            clip = self._clips.get(key)
+            if clip is not None:
+                self._clips.move_to_end(key)
+                self.hits += 1
+                return clip
+            self.misses += 1
+
+        digest = file_digest(path)
+        frames = self._read_disk(digest)
+        if frames is None:
+            frames = self._encode(path)
+            self._write_disk(digest, frames)
+
+        clip = OpusClip(path, digest, frames)
+        self._store(key, clip)
+        return clip
+
+    def encode_to_disk(self, path, digest):
+        """Blocking: makes sure the disk cache has ``path``, without loading it into memory."""
+        if self._disk_path(digest).exists():
+            return False
+        self._write_disk(digest, self._encode(path))
+        return True
+
+    def evict(self, path=None):
+        """Drops ``path`` (or everything) from memory. The disk cache is kept."""
+        with self._lock:
+            for key in [k for k in self._clips if path is None or k[0] == str(path)]:
+                self._bytes -= self._clips.pop(key).size
+
+    def _key(self, path):
+        stat = os.stat(path)
+        return str(path), stat.st_mtime_ns, stat.st_size
+
+    def _store(self, key, clip):
+        with self._lock:
+            old = self._clips.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._clips[key] = clip
+            self._bytes += clip.size
+            while self._bytes > self.max_bytes and len(self._clips) > 1:
+                _, evicted = self._clips.popitem(last=False)
+                self._bytes -= evicted.size
+                logger.debug('Evicted %s from the opus cache', evicted.path)
+
+    def _encode(self, path):
+        args = [self.executable, '-nostdin', '-loglevel', 'error', '-i', str(path), *ENCODE_ARGS, 'pipe:1']
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+        if result.returncode != 0:
+            raise RuntimeError(f'ffmpeg failed for {path}: {result.stderr.decode(errors="replace").strip()}')
+        return [
+            packet for packet in OggStream(io.BytesIO(result.stdout)).iter_packets()
+            if not packet.startswith((b'OpusHead', b'OpusTags'))
+        ]
+
+    def _disk_path(self, digest):
+        return self.cache_dir / digest[:2] / f'{digest}.opus'
+
+    def _read_disk(self, digest):
+        try:
+            data = self._disk_path(digest).read_bytes()
+        except FileNotFoundError:
+            return None
+        if not data.startswith(CACHE_MAGIC):
+            return None
+
+        frames = []
+        view = memoryview(data)
+        offset = len(CACHE_MAGIC)
+        try:
+            while offset < len(data):
+                (length,) = FRAME_HEADER.unpack_from(view, offset)
+                offset += FRAME_HEADER.size
+                frame = bytes(view[offset:offset + length])
+                if len(frame) != length:
+                    return None
+                frames.append(frame)
+                offset += length
+        except struct.error:
+            return None
+        return frames
+
+    def _write_disk(self, digest, frames):
+        path = self._disk_path(digest)
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, 'wb') as fp:
+                fp.write(CACHE_MAGIC)
+                for frame in frames:
+                    fp.write(FRAME_HEADER.pack(len(frame)))
+                    fp.write(frame)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning('Could not write opus cache entry %s: %s', path, e)
+            tmp.unlink(missing_ok=True)
@@ -0,0 +1,116 @@
+import logging
+import time
+
+import discord
+
+from metrics import OPUS_COMPLEXITY, OPUS_ENCODE
+
+logger = logging.getLogger(__name__)
+
+# OPUS_SET_COMPLEXITY_REQUEST, which discord.py doesn't wrap
+CTL_SET_COMPLEXITY = 4010
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+# Weight of the newest frame in the encode time average
+SMOOTHING = 0.02
+# Frames (two seconds) the average gets to settle between complexity changes
+HOLD_FRAMES = 100
+
+
+class EncoderPolicy:
+    """Picks the opus settings for what a voice channel is playing.
+
+    Music is encoded at up to ``music_bitrate`` kbps and clips at up to
+    ``clip_bitrate``, never above what the channel itself carries, as
+    anything more is thrown away before listeners get it. In-band FEC only
+    works in opus's speech modes, so it's on for clips (which are mostly
+    speech) and off for music, where asking for it would only push the
+    encoder towards those modes.
+    """
+
+    def __init__(self, *, music_bitrate=128, clip_bitrate=64, expected_packet_loss=0.15,
+                 budget=0.25, min_complexity=3, max_complexity=10):
+        self.music_bitrate = music_bitrate
+        self.clip_bitrate = clip_bitrate
+        self.expected_packet_loss = expected_packet_loss
+        self.budget = budget
+        self.min_complexity = min_complexity
+        self.max_complexity = max_complexity
+
+    def settings(self, channel_bitrate, music):
+        """Returns ``(bitrate, signal_type, fec)`` for a channel of ``channel_bitrate`` bps."""
+        cap = self.music_bitrate if music else self.clip_bitrate
+        # 64 kbps is what Discord gives a channel unless told otherwise
+        bitrate = max(16, min(cap, (channel_bitrate or 64000) // 1000))
+        return bitrate, 'music' if music else 'auto', not music
+
+    def encoder(self, voice_client, mixer, previous=None):
+        """Returns the encoder for ``voice_client``'s new ``mixer``, keeping the complexity ``previous`` got to."""
+        complexity = previous.complexity if isinstance(previous, AdaptiveEncoder) else self.max_complexity
+        return AdaptiveEncoder(voice_client, mixer, self, complexity=complexity)
+
+
+class AdaptiveEncoder(discord.opus.Encoder):
+    """An opus encoder that follows its channel and mixer, and backs off when encoding gets slow.
+
+    Before each frame it checks whether the mixer switched between music and
+    clips or the channel's bitrate changed, and reconfigures itself if so.
+    Every encode is timed (wall clock, so waiting for a busy CPU counts); when
+    the average nears the policy's ``budget`` share of a 20 ms frame the
+    complexity is lowered one step, and it's raised again once encoding
+    takes less than half of that.
+    """
+
+    def __init__(self, voice_client, mixer, policy, *, complexity=10):
+        super().__init__()
+        self.voice_client = voice_client
+        self.mixer = mixer
+        self.policy = policy
+        self.complexity = None
+        self.average = 0.0
+        self._state_key = None
+        self._timing = None
+        self._held = 0
+        self.set_complexity(complexity)
+
+    def set_complexity(self, complexity):
+        discord.opus._lib.opus_encoder_ctl(self._state, CTL_SET_COMPLEXITY, complexity)
+        self.complexity = complexity
+
+    def configure(self, channel_bitrate, music):
+        bitrate, signal_type, fec = self.policy.settings(channel_bitrate, music)
+        self.set_bitrate(bitrate)
+        self.set_signal_type(signal_type)
+        self.set_fec(fec)
+        self.set_expected_packet_loss_percent(self.policy.expected_packet_loss if fec else 0)
+        self._timing = OPUS_ENCODE.labels(signal_type)
+        logger.debug('Encoding %s at %d kbps for guild %s', 'music' if music else 'clips', bitrate,
+                     self.voice_client.guild.id)
+
+    def encode(self, pcm, frame_size):
+        key = (getattr(self.voice_client.channel, 'bitrate', None), self.mixer.playing_music)
+        if key != self._state_key:
+            self._state_key = key
+            self.configure(*key)
+
+        started = time.perf_counter()
+        data = super().encode(pcm, frame_size)
+        elapsed = time.perf_counter() - started
+        self._timing.observe(elapsed)
+        self.average += (elapsed - self.average) * SMOOTHING
+        self._held += 1
+        if self._held >= HOLD_FRAMES:
+            self._adapt()
+        return data
+
+    def _adapt(self):
+        budget = self.policy.budget * FRAME_SECONDS
+        if self.average > budget and self.complexity > self.policy.min_complexity:
+            self.set_complexity(self.complexity - 1)
+            OPUS_COMPLEXITY.labels('down').inc()
+            logger.debug('Encoding took %.2f ms a frame, complexity lowered to %d', self.average * 1000, self.complexity)
+        elif self.average < budget / 2 and self.complexity < self.policy.max_complexity:
+            self.set_complexity(self.complexity + 1)
+            OPUS_COMPLEXITY.labels('up').inc()
+        else:
+            return
+        self._held = 0
@@ -0,0 +1,191 @@
+import logging
+import shlex
+import subprocess
+import threading
+
+import discord
+from discord.oggparse import OggStream
+from discord.opus import OPUS_SILENCE
+
+logger = logging.getLogger(__name__)
+
+ENCODE_ARGS = [
+    '-vn',
+    '-map_metadata', '-1',
+    '-f', 'opus',
+    '-c:a', 'libopus',
+    '-ar', '48000',
+    '-ac', '2',
+    '-b:a', '128k',
+    '-loglevel', 'warning',
+]
+
+
+class StationRelay:
+    """One upstream connection and encoder for a station, shared by every guild listening to it.
+
+    An ffmpeg process encodes the stream to opus; a reader thread puts the
+    packets into a ring buffer of ``capacity`` frames. Each subscriber keeps its
+    own read cursor into the buffer, so a slow or late listener never holds up
+    the others. Once the last subscriber leaves the relay shuts down after
+    ``grace`` seconds unless someone subscribes again.
+    """
+
+    def __init__(self, url, *, capacity=500, prebuffer=10, grace=30, executable='ffmpeg', before_options=None):
+        self.url = url
+        self.capacity = capacity
+        self.prebuffer = prebuffer
+        self.grace = grace
+        self.executable = executable
+        self.before_options = before_options
+        self.head = 0  # Total number of packets written so far
+        self.closed = False
+        self.subscribers = 0
+        self.on_close = None
+        self._ring = [b''] * capacity
+        self._lock = threading.Lock()
+        self._process = None
+        self._idle_timer = None
+
+    def start(self):
+        args = [self.executable, '-nostdin']
+        if self.before_options:
+            args.extend(shlex.split(self.before_options))
+        args.extend(['-i', self.url, *ENCODE_ARGS, 'pipe:1'])
+        self._process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        threading.Thread(target=self._pump, name=f'radio-relay:{self.url}', daemon=True).start()
+
+    def subscribe(self):
+        with self._lock:
+            if self.closed:
+                raise RuntimeError('relay is closed')
+            self.subscribers += 1
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            # Start slightly behind live to absorb network jitter
+            cursor = max(0, self.head - self.prebuffer)
+        return RelaySubscriber(self, cursor)
+
+    def unsubscribe(self):
+        with self._lock:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.closed:
+                self._idle_timer = threading.Timer(self.grace, self._close_if_idle)
+                self._idle_timer.daemon = True
+                self._idle_timer.start()
+
+    def read(self, cursor):
+        """Returns ``(packet, next_cursor)``. ``packet`` is ``b''`` once the relay is closed.
+
+        Never waits: the audio thread reading this also mixes the clips over
+        it, so a station that's connecting or stalled gets ``None`` right away.
+        """
+        with self._lock:
+            if cursor < self.head - self.capacity:
+                # Fell out of the ring buffer, skip ahead instead of replaying stale audio
+                cursor = self.head - self.prebuffer
+            if cursor < self.head:
+                return self._ring[cursor % self.capacity], cursor + 1
+            if self.closed:
+                return b'', cursor
+        return None, cursor
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def _close_if_idle(self):
+        with self._lock:
+            if self.subscribers:
+                return
+        logger.info('Closing idle relay for %s', self.url)
+        self.close()
+
+    def _pump(self):
+        try:
+            for packet in OggStream(self._process.stdout).iter_packets():
+                if packet.startswith((b'OpusHead', b'OpusTags')):
+                    continue
+                with self._lock:
+                    if self.closed:
+                        return
+                    self._ring[self.head % self.capacity] = packet
+                    self.head += 1
+        except Exception:
+            logger.exception('Relay for %s failed', self.url)
+        finally:
+            self.close()
+            self._process.wait()
+
+
+class RelaySubscriber(discord.AudioSource):
+    """A voice client's view of a :class:`StationRelay`.
+
+    :attr:`started` is set once a packet of the station itself was read, the
+    silence sent while it connects doesn't count as its first audio.
+    """
+
+    def __init__(self, relay, cursor):
+        self.relay = relay
+        self.cursor = cursor
+        self.started = False
+        self._done = False
+
+    def read(self):
+        packet, self.cursor = self.relay.read(self.cursor)
+        if packet is None:
+            # Connecting or stalled upstream, keep the voice connection fed
+            return OPUS_SILENCE
+        self.started = True
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if not self._done:
+            self._done = True
+            self.relay.unsubscribe()
+
+
+class RadioRelays:
+    """Keeps at most one :class:`StationRelay` per station URL."""
+
+    def __init__(self, **relay_options):
+        self.relay_options = relay_options
+        self.relays = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, url):
+        with self._lock:
+            relay = self.relays.get(url)
+            if relay is not None:
+                try:
+                    return relay.subscribe()
+                except RuntimeError:
+                    pass  # Closed by its idle timer just now
+            relay = StationRelay(url, **self.relay_options)
+            relay.on_close = self._forget
+            relay.start()
+            self.relays[url] = relay
+            return relay.subscribe()
+
+    def close(self):
+        with self._lock:
+            relays = list(self.relays.values())
+        for relay in relays:
+            relay.close()
+
+    def _forget(self, relay):
+        with self._lock:
+            if self.relays.get(relay.url) is relay:
+                del self.relays[relay.url]
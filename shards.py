@@ -0,0 +1,150 @@
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import time
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+# Discord allows one IDENTIFY per max_concurrency bucket every 5 seconds
+IDENTIFY_INTERVAL = 5.0
+
+
+async def recommended_shards(token):
+    """Returns Discord's recommended shard count and the bot's identify concurrency."""
+    client = discord.Client(intents=discord.Intents.none())
+    try:
+        await client.login(token)
+        shards, _, limits = await client.http.get_bot_gateway()
+        return shards, limits.get('max_concurrency', 1)
+    finally:
+        await client.close()
+
+
+def plan_shards(shard_count, workers):
+    """Splits shards ``0..shard_count-1`` into at most ``workers`` contiguous, evenly sized runs."""
+    workers = max(1, min(workers, shard_count))
+    size = math.ceil(shard_count / workers)
+    return [list(range(start, min(start + size, shard_count))) for start in range(0, shard_count, size)]
+
+
+class ShardWorker:
+    __slots__ = ('index', 'shard_ids', 'process', 'started_at', 'restart_delay', 'restart_at')
+
+    def __init__(self, index, shard_ids):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at = None
+
+
+class ShardSupervisor:
+    """Runs one process per group of shards and restarts the ones that die.
+
+    ``target(worker_index, shard_ids, shard_count)`` is called in each worker
+    process; the index is also in its ``SOMALEZU_SHARD_WORKER`` environment
+    variable, so module-level configuration can already see it. Workers are
+    started one after another, spaced so their shards don't exceed Discord's
+    identify rate together. A worker that dies is restarted after
+    ``restart_delay`` seconds, doubling up to ``max_restart_delay`` while it
+    keeps dying within ``stable_after`` seconds of starting. ``on_tick`` is
+    called every ``tick_interval`` seconds in the supervisor itself, for work
+    that should happen once rather than per worker.
+    """
+
+    def __init__(self, target, shard_count, workers, *, max_concurrency=1, restart_delay=1.0,
+                 max_restart_delay=60.0, stable_after=60.0, on_tick=None, tick_interval=60.0):
+        self.target = target
+        self.shard_count = shard_count
+        self.max_concurrency = max(1, max_concurrency)
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.on_tick = on_tick
+        self.tick_interval = tick_interval
+        self.workers = [ShardWorker(index, ids) for index, ids in enumerate(plan_shards(shard_count, workers))]
+        self.stopping = False
+        self._context = multiprocessing.get_context('spawn')
+
+    def run(self):
+        """Blocking: supervises the workers until SIGINT or SIGTERM."""
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._stop)
+        logger.info('Running %d shards in %d worker processes', self.shard_count, len(self.workers))
+
+        next_tick = time.monotonic()
+        try:
+            for worker in self.workers:
+                if self.stopping:
+                    break
+                self._start(worker)
+                self._sleep(IDENTIFY_INTERVAL * math.ceil(len(worker.shard_ids) / self.max_concurrency))
+
+            while not self.stopping:
+                now = time.monotonic()
+                if self.on_tick is not None and now >= next_tick:
+                    next_tick = now + self.tick_interval
+                    try:
+                        self.on_tick()
+                    except Exception:
+                        logger.exception('Supervisor tick failed')
+                for worker in self.workers:
+                    self._check(worker, now)
+                self._sleep(1)
+        finally:
+            self._shutdown()
+
+    def _check(self, worker, now):
+        if worker.restart_at is not None:
+            if now >= worker.restart_at:
+                self._start(worker)
+            return
+        if worker.process.is_alive():
+            return
+
+        lived = now - worker.started_at
+        if lived >= self.stable_after:
+            worker.restart_delay = self.restart_delay
+        else:
+            worker.restart_delay = min(max(worker.restart_delay * 2, self.restart_delay), self.max_restart_delay)
+        worker.restart_at = now + worker.restart_delay
+        logger.warning(
+            'Worker %d (shards %s) exited with %s after %.0fs, restarting in %.0fs',
+            worker.index, worker.shard_ids, worker.process.exitcode, lived, worker.restart_delay,
+        )
+
+    def _start(self, worker):
+        # Copied into the child's environment when it's spawned
+        os.environ['SOMALEZU_SHARD_WORKER'] = str(worker.index)
+        # Shard workers run their own extraction worker processes, so they can't be daemonic
+        worker.process = self._context.Process(
+            target=self.target, args=(worker.index, worker.shard_ids, self.shard_count),
+            name=f'somalezu-shard-worker-{worker.index}',
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logger.info('Started worker %d (pid %s) for shards %s', worker.index, worker.process.pid, worker.shard_ids)
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(0.5, deadline - time.monotonic()))
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _shutdown(self):
+        running = [w.process for w in self.workers if w.process is not None and w.process.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + 10
+        for process in running:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
@@ -1,23 +1,59 @@
 import asyncio
 import logging
 import os
+import signal
+import time
 from functools import wraps
 from pathlib import Path
 
 import discord
-import yt_dlp as youtube_dl
 from discord import app_commands
 from discord.ui import View, Button
-from discord.ext import commands
+from discord.ext import commands, tasks
 from dotenv import load_dotenv
 
-discord.utils.setup_logging(
-    level=logging.DEBUG,
-    root=True,
+from guild_state import GuildState, TrackRecord, process_rss
+import av_audio
+import log_queue
+import metrics
+from extraction import ExtractionBusy, ExtractionCache, ExtractionPool, iter_playlist, normalize_url
+from loop_watchdog import LoopWatchdog
+from loudness import LoudnessStore
+from media_cache import CachedTrackAudio, MediaCache
+from metrics import FIRST_AUDIO, SOURCE_STARTUP, observe_since
+from mixer import MixerSource
+from music_library import MusicLibrary, SCHEME as LIBRARY_SCHEME, scan as scan_library
+from opus_cache import OpusClipCache
+from opus_policy import EncoderPolicy
+from radio_relay import RadioRelays
+from shards import ShardSupervisor, recommended_shards
+from sound_index import SoundIndex, scan
+from track_queue import GuildQueue, LazyPlaylist, QueuedTrack
+from track_search import TrackSearch
+from voice_sessions import VoiceSessions
+
+load_dotenv(override=True)
+
+# Log records are formatted and written by a background thread. LOG_FORMAT is 'text' or 'json'.
+# LOG_RATE_LIMITS caps the debug and info records per second of a logger, LOG_SAMPLING keeps
+# only a share of them, both as comma separated logger=value pairs.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_RATE_LIMITS = os.getenv(
+    'LOG_RATE_LIMITS', 'discord.gateway=20,discord.state=20,discord.http=10,discord.voice_state=5,discord.voice_client=5',
+)
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', '')
+
+log_queue.setup_logging(
+    LOG_LEVEL,
+    json_output=LOG_FORMAT == 'json',
+    # Tells the sharded mode's processes apart
+    fields={'worker': os.getenv('SOMALEZU_SHARD_WORKER', 'main')},
+    rate_limits=log_queue.parse_rates(LOG_RATE_LIMITS),
+    sample_rates=log_queue.parse_rates(LOG_SAMPLING),
 )
 logger = logging.getLogger(__name__)
 
-load_dotenv(override=True)
 TOKEN = os.getenv('DISCORD_TOKEN')
 GUILD_ID = os.getenv('GUILD_ID')
 MY_GUILD = discord.Object(id=int(GUILD_ID))
@@ -25,9 +61,6 @@ MY_GUILD = discord.Object(id=int(GUILD_ID))
 if TOKEN is None:
     raise ValueError("No DISCORD_TOKEN found")
 
-# Suppress noise about console usage from errors
-youtube_dl.utils.bug_reports_message = lambda: ''
-
 ytdl_format_options = {
     'format': 'bestaudio/best',
     'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
@@ -48,178 +81,406 @@ ffmpeg_options = {
     'options': '-vn',
 }
 
-SOUNDBOARD_MAPPING = {
+# Send opus streams through without decoding them, as long as nothing needs to be mixed in
+OPUS_PASSTHROUGH = os.getenv('OPUS_PASSTHROUGH', '1') == '1'
+
+# How other streams are decoded: 'ffmpeg' (one subprocess each) or 'av' (in-process, needs PyAV)
+AUDIO_BACKEND = os.getenv('AUDIO_BACKEND', 'ffmpeg')
+if AUDIO_BACKEND == 'av' and not av_audio.AVAILABLE:
+    logger.warning('AUDIO_BACKEND is av but PyAV is not installed, falling back to ffmpeg')
+    AUDIO_BACKEND = 'ffmpeg'
+
+# Seconds a radio relay stays up after its last listener left
+RADIO_RELAY_GRACE = float(os.getenv('RADIO_RELAY_GRACE', '30'))
+
+# Soundboard clips are indexed from this directory and rescanned periodically
+SOUNDS_DIR = os.getenv('SOUNDS_DIR', 'sounds')
+SOUND_MANIFEST = os.getenv('SOUND_MANIFEST', '.cache/sound_index.json')
+SOUND_RESCAN_INTERVAL = float(os.getenv('SOUND_RESCAN_INTERVAL', '60'))
+
+# Audio files under MUSIC_LIBRARY_DIR are indexed by their tags and path, and /play looks
+# there before going online. Unset to disable.
+MUSIC_LIBRARY_DIR = os.getenv('MUSIC_LIBRARY_DIR', '')
+MUSIC_LIBRARY_INDEX = os.getenv('MUSIC_LIBRARY_INDEX', '.cache/music_library.json')
+MUSIC_LIBRARY_RESCAN_INTERVAL = float(os.getenv('MUSIC_LIBRARY_RESCAN_INTERVAL', '300'))
+
+# Pre-encoded soundboard clips
+OPUS_CACHE_DIR = os.getenv('OPUS_CACHE_DIR', '.cache/opus')
+OPUS_CACHE_MAX_BYTES = int(os.getenv('OPUS_CACHE_MAX_MB', '64')) * 1024 * 1024
+
+# Max number of soundboard clips mixed over the music at once
+MIXER_MAX_VOICES = int(os.getenv('MIXER_MAX_VOICES', '8'))
+
+# Opus bitrates (kbps) for music and for clips, never above the voice channel's own. An encoder
+# lowers its complexity (down to OPUS_MIN_COMPLEXITY) while encoding a frame takes more than
+# OPUS_ENCODE_BUDGET of its 20 ms, and raises it again once it's fast enough.
+OPUS_MUSIC_BITRATE = int(os.getenv('OPUS_MUSIC_BITRATE', '128'))
+OPUS_CLIP_BITRATE = int(os.getenv('OPUS_CLIP_BITRATE', '64'))
+OPUS_ENCODE_BUDGET = float(os.getenv('OPUS_ENCODE_BUDGET', '0.25'))
+OPUS_MIN_COMPLEXITY = int(os.getenv('OPUS_MIN_COMPLEXITY', '3'))
+OPUS_MAX_COMPLEXITY = int(os.getenv('OPUS_MAX_COMPLEXITY', '10'))
+
+# Extracted stream info is reused until its signed URL expires
+EXTRACTION_CACHE_SIZE = int(os.getenv('EXTRACTION_CACHE_SIZE', '256'))
+EXTRACTION_CACHE_TTL = int(os.getenv('EXTRACTION_CACHE_TTL', '600'))
+
+# yt-dlp runs in its own worker processes
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '2'))
+EXTRACTION_MAX_QUEUE = int(os.getenv('EXTRACTION_MAX_QUEUE', '16'))
+EXTRACTION_TIMEOUT = float(os.getenv('EXTRACTION_TIMEOUT', '30'))
+
+# How many upcoming queue entries are resolved ahead of time, and whether the
+# next one also gets its ffmpeg pipeline opened early
+PREFETCH_TRACKS = int(os.getenv('PREFETCH_TRACKS', '2'))
+PREFETCH_PIPELINES = os.getenv('PREFETCH_PIPELINES', '0') == '1'
+QUEUE_PAGE_SIZE = 10
+
+# Playlists are listed this many entries at a time, as the queue reaches them
+PLAYLIST_PAGE_SIZE = int(os.getenv('PLAYLIST_PAGE_SIZE', '50'))
+
+# /play suggests search results once a user stopped typing for PLAY_SEARCH_DEBOUNCE seconds;
+# results are kept PLAY_SEARCH_TTL seconds for the last PLAY_SEARCH_CACHE_SIZE queries
+PLAY_SEARCH_DEBOUNCE = float(os.getenv('PLAY_SEARCH_DEBOUNCE', '0.4'))
+PLAY_SEARCH_TTL = float(os.getenv('PLAY_SEARCH_TTL', '600'))
+PLAY_SEARCH_CACHE_SIZE = int(os.getenv('PLAY_SEARCH_CACHE_SIZE', '512'))
+# Searches get their own extraction workers, so typing never holds up playback
+PLAY_SEARCH_WORKERS = int(os.getenv('PLAY_SEARCH_WORKERS', '1'))
+PLAY_SEARCH_MAX_QUEUE = int(os.getenv('PLAY_SEARCH_MAX_QUEUE', '4'))
+
+# Clips and tracks are played at this loudness (LUFS), measured once per file or track.
+# Within LOUDNESS_TOLERANCE dB of it opus audio is left untouched so it can pass through.
+LOUDNESS_TARGET = float(os.getenv('LOUDNESS_TARGET', '-20'))
+LOUDNESS_MAX_PEAK = float(os.getenv('LOUDNESS_MAX_PEAK', '-1'))
+LOUDNESS_TOLERANCE = float(os.getenv('LOUDNESS_TOLERANCE', '1'))
+TRACK_LOUDNESS_STORE = os.getenv('TRACK_LOUDNESS_STORE', '.cache/track_loudness.json')
+
+# Tracks played at least MEDIA_CACHE_MIN_PLAYS times are kept on disk as opus
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', '.cache/media')
+MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_MB', '2048')) * 1024 * 1024
+MEDIA_CACHE_MIN_PLAYS = int(os.getenv('MEDIA_CACHE_MIN_PLAYS', '3'))
+
+# Per-guild state is dropped when the bot leaves a guild's voice channel,
+# or after this many seconds without anything playing or queued
+GUILD_IDLE_TIMEOUT = float(os.getenv('GUILD_IDLE_TIMEOUT', '600'))
+
+# Voice connections are dropped after this many seconds without anyone in the channel.
+# Members who used this many commands get the bot pre-connected when they join a channel (0 to disable).
+VOICE_IDLE_TIMEOUT = float(os.getenv('VOICE_IDLE_TIMEOUT', '300'))
+VOICE_PRECONNECT_USES = int(os.getenv('VOICE_PRECONNECT_USES', '3'))
+
+# Prometheus metrics are served on this port (plus the worker index in sharded mode), 0 to disable
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# The event loop's lag is sampled every LOOP_WATCHDOG_INTERVAL seconds; the stack of anything
+# blocking it for longer than LOOP_BLOCK_THRESHOLD seconds is logged (0 to disable)
+LOOP_WATCHDOG_INTERVAL = float(os.getenv('LOOP_WATCHDOG_INTERVAL', '0.1'))
+LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', '0.25'))
+
+# Sharded mode: SHARD_WORKERS processes each run a share of SHARD_COUNT shards
+# (0 for Discord's recommendation). Off when SHARD_WORKERS is 0.
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+# Set by the shard supervisor in each worker process
+SHARD_WORKER = os.getenv('SOMALEZU_SHARD_WORKER')
+
+if SHARD_WORKER is not None:
+    # The sound index and clip cache are shared read-only, caches written at runtime are per worker
+    MEDIA_CACHE_DIR = os.path.join(MEDIA_CACHE_DIR, f'worker-{SHARD_WORKER}')
+    TRACK_LOUDNESS_STORE = f'{os.path.splitext(TRACK_LOUDNESS_STORE)[0]}.worker-{SHARD_WORKER}.json'
+
+# Button emoji per file in sounds/, in the order they appear on the soundboard.
+# Files not listed here still show up, after these, labelled with their name.
+SOUND_EMOJIS = {
     # Cena variations
-    '🎵': 'sounds/cena.mp3',
-    '1️⃣': 'sounds/cena1.mp3',
-    '2️⃣': 'sounds/cena2.mp3',
-    '3️⃣': 'sounds/cena3.mp3',
-    '4️⃣': 'sounds/cena4.mp3',
-    '5️⃣': 'sounds/cena5.mp3',
+    'cena.mp3': '🎵',
+    'cena1.mp3': '1️⃣',
+    'cena2.mp3': '2️⃣',
+    'cena3.mp3': '3️⃣',
+    'cena4.mp3': '4️⃣',
+    'cena5.mp3': '5️⃣',
     
     # Original mappings
-    '🎹': 'sounds/cookie.mp3',
-    '🥁': 'sounds/cop.mp3',
-    '🎤': 'sounds/lisan.mp3',
+    'cookie.mp3': '🎹',
+    'cop.mp3': '🥁',
+    'lisan.mp3': '🎤',
     
     #Mario
-    '🪘': 'sounds/a cazut berea.mp3',
-    '🎷': 'sounds/am prins peste.mp3',
-    '🎺': 'sounds/colega.mp3',
+    'a cazut berea.mp3': '🪘',
+    'am prins peste.mp3': '🎷',
+    'colega.mp3': '🎺',
     
     # Trump
-    '🎻': 'sounds/fake.mp3',
-    '🎸': 'sounds/obamna.mp3',
-    '⚖️': 'sounds/because-youd-be-in-jail-101soundboards.mp3',
-    '🧠': 'sounds/big-brain-101soundboards.mp3',
-    '🌟': 'sounds/it-was-terrifiic-101soundboards.mp3',
+    'fake.mp3': '🎻',
+    'obamna.mp3': '🎸',
+    'because-youd-be-in-jail-101soundboards.mp3': '⚖️',
+    'big-brain-101soundboards.mp3': '🧠',
+    'it-was-terrifiic-101soundboards.mp3': '🌟',
 
     # New additions
-    '🧛': 'sounds/chinarespectstrumpbrain.mp3',
-    '🍖': 'sounds/eatingdogs.mp3',
+    'chinarespectstrumpbrain.mp3': '🧛',
+    'eatingdogs.mp3': '🍖',
     
     # Previous additions
     # arnold
-    '🏗️': 'sounds/construction-101soundboards.mp3',
-    '🎙️': 'sounds/asking-101soundboards.mp3',
-    '✅': 'sounds/correct-a-mundo-101soundboards.mp3',
-    '❌': 'sounds/but-you-told-me-no-you-cant-say-no-101soundboards.mp3',
-    '🤝': 'sounds/count-on-me-101soundboards.mp3',
-    '💊': 'sounds/drug-101soundboards.mp3',
-    '🍑': 'sounds/i-do-not-want-to-touch-his-ass-101soundboards.mp3',
-    '🥷': 'sounds/ninja-101soundboards.mp3',
+    'construction-101soundboards.mp3': '🏗️',
+    'asking-101soundboards.mp3': '🎙️',
+    'correct-a-mundo-101soundboards.mp3': '✅',
+    'but-you-told-me-no-you-cant-say-no-101soundboards.mp3': '❌',
+    'count-on-me-101soundboards.mp3': '🤝',
+    'drug-101soundboards.mp3': '💊',
+    'i-do-not-want-to-touch-his-ass-101soundboards.mp3': '🍑',
+    'ninja-101soundboards.mp3': '🥷',
 
     # pulp
-    '😱': 'sounds/fuck-what-the-fuck-101soundboards.mp3',
-    '🎯': 'sounds/concentration-101soundboards.mp3',
+    'fuck-what-the-fuck-101soundboards.mp3': '😱',
+    'concentration-101soundboards.mp3': '🎯',
 
     #
-    '🦸🏽‍♂️': 'sounds/calculator-is-going-up-your-ass-tonight-101soundboards.mp3',
-    '🍬': 'sounds/candy-shop-101soundboards.mp3',
-    '🔫': 'sounds/does-he-look-like-a-bitch-101soundboards.mp3',
-    '🇬🇧': 'sounds/english-101soundboards.mp3',
-    '🙋': 'sounds/excuse-me-101soundboards.mp3',
-    '🤬': 'sounds/fu-101soundboards.mp3',
-    '😂': 'sounds/funny-101soundboards.mp3',
-    '💭': 'sounds/had-say-101soundboards.mp3',
-    '👶': 'sounds/how-we-doin-baby-101soundboards.mp3',
-    '🎓': 'sounds/i-have-the-best-words-i-know-words-i-went-to-an-ivy-league-school-highly-educated-president-101soundboards.mp3',
-    '🕵️': 'sounds/im-detective-john-kimble-101soundboards.mp3',
-    '💣': 'sounds/im-gonna-bomb-the-sht-out-of-them-bomb-moab-isis-trump-101soundboards.mp3',
-    '🙅': 'sounds/im-not-interested-in-that-101soundboards.mp3',
-    '🥒': 'sounds/im-pickle-rick-101soundboards.mp3',
-    '❓': 'sounds/i-want-to-ask-you-a-bunch-of-questions-and-i-want-to-ha-101soundboards.mp3',
-    '📚': 'sounds/i-would-like-to-talk-to-you-about-thomas-aquinas-101soundboards.mp3',
-    '💪': 'sounds/john-cena-prank-call-ringtone-101soundboards.mp3',
-    '✨': 'sounds/just-do-it-101soundboards.mp3',
-    '👍': 'sounds/like-101soundboards.mp3',
-    '👊': 'sounds/nobody-would-be-tougher-on-isis-than-donald-trump-101soundboards.mp3',
-    '🤫': 'sounds/no-talk-101soundboards.mp3',
-    '📢': 'sounds/nyess-101soundboards.mp3',
-    '🎮': 'sounds/pb-101soundboards.mp3',
-    '😺': 'sounds/pussy2night.mp3',
-    '😨': 'sounds/scream-101soundboards.mp3',
-    '🔞': 'sounds/sex-101soundboards.mp3',
-    '🤐': 'sounds/shut-the-fuck-up-stfu-shut-up-be-quiet-stop-talking-suck-my-dick-suck-it-101soundboards.mp3',
-    '👃': 'sounds/something-smells-awfully-like-shit-101soundboards.mp3',
-    '🦕': 'sounds/stegosaurus-pussy-101soundboards.mp3',
-    '🚫': 'sounds/stfu-101soundboards.mp3',
-    '✋': 'sounds/stop-101soundboards.mp3',
-    '🛑': 'sounds/stop-it-101soundboards.mp3',
-    '🌾': 'sounds/welcome-to-the-rice-fields-mother-fucker-101soundboards.mp3',
-    '🔥': 'sounds/youre-fired-101soundboards.mp3',
-    '📺': 'sounds/youre-the-asshole-on-tv-101soundboards.mp3',
+    'calculator-is-going-up-your-ass-tonight-101soundboards.mp3': '🦸🏽‍♂️',
+    'candy-shop-101soundboards.mp3': '🍬',
+    'does-he-look-like-a-bitch-101soundboards.mp3': '🔫',
+    'english-101soundboards.mp3': '🇬🇧',
+    'excuse-me-101soundboards.mp3': '🙋',
+    'fu-101soundboards.mp3': '🤬',
+    'funny-101soundboards.mp3': '😂',
+    'had-say-101soundboards.mp3': '💭',
+    'how-we-doin-baby-101soundboards.mp3': '👶',
+    'i-have-the-best-words-i-know-words-i-went-to-an-ivy-league-school-highly-educated-president-101soundboards.mp3': '🎓',
+    'im-detective-john-kimble-101soundboards.mp3': '🕵️',
+    'im-gonna-bomb-the-sht-out-of-them-bomb-moab-isis-trump-101soundboards.mp3': '💣',
+    'im-not-interested-in-that-101soundboards.mp3': '🙅',
+    'im-pickle-rick-101soundboards.mp3': '🥒',
+    'i-want-to-ask-you-a-bunch-of-questions-and-i-want-to-ha-101soundboards.mp3': '❓',
+    'i-would-like-to-talk-to-you-about-thomas-aquinas-101soundboards.mp3': '📚',
+    'john-cena-prank-call-ringtone-101soundboards.mp3': '💪',
+    'just-do-it-101soundboards.mp3': '✨',
+    'like-101soundboards.mp3': '👍',
+    'nobody-would-be-tougher-on-isis-than-donald-trump-101soundboards.mp3': '👊',
+    'no-talk-101soundboards.mp3': '🤫',
+    'nyess-101soundboards.mp3': '📢',
+    'pb-101soundboards.mp3': '🎮',
+    'pussy2night.mp3': '😺',
+    'scream-101soundboards.mp3': '😨',
+    'sex-101soundboards.mp3': '🔞',
+    'shut-the-fuck-up-stfu-shut-up-be-quiet-stop-talking-suck-my-dick-suck-it-101soundboards.mp3': '🤐',
+    'something-smells-awfully-like-shit-101soundboards.mp3': '👃',
+    'stegosaurus-pussy-101soundboards.mp3': '🦕',
+    'stfu-101soundboards.mp3': '🚫',
+    'stop-101soundboards.mp3': '✋',
+    'stop-it-101soundboards.mp3': '🛑',
+    'welcome-to-the-rice-fields-mother-fucker-101soundboards.mp3': '🌾',
+    'youre-fired-101soundboards.mp3': '🔥',
+    'youre-the-asshole-on-tv-101soundboards.mp3': '📺',
        # Golan variations
-    '🦷': 'sounds/golan1.mp3',
+    'golan1.mp3': '🦷',
 
     # Maneaua Hackerilor variations
-    '👋': 'sounds/maneauahackerilor2.mp3',
-    '🦝': 'sounds/maneauahackerilor3.mp3',
-    '🦊': 'sounds/maneauahackerilor4.mp3',
-    '🐺': 'sounds/maneauahackerilor5.mp3',
+    'maneauahackerilor2.mp3': '👋',
+    'maneauahackerilor3.mp3': '🦝',
+    'maneauahackerilor4.mp3': '🦊',
+    'maneauahackerilor5.mp3': '🐺',
     # Scapitanu variations
-    '⚓': 'sounds/scapitanu.mp3',
+    'scapitanu.mp3': '⚓',
 
     # Scap si Pajura variations
-    '🦅': 'sounds/scapsipajura2.mp3',
-    '🤠': 'sounds/scapsipajura3.mp3',
-    '👽': 'sounds/scapsipajura.mp3',
+    'scapsipajura2.mp3': '🦅',
+    'scapsipajura3.mp3': '🤠',
+    'scapsipajura.mp3': '👽',
 
     # Schef de Chef
-    '👨‍🍳': 'sounds/schefdechef.mp3',
+    'schefdechef.mp3': '👨‍🍳',
 
     # Sistemul Nr 1
-    '🔢': 'sounds/sistemulnr1.mp3',
+    'sistemulnr1.mp3': '🔢',
 
     # SMJ
-    '🎤': 'sounds/sMJ.mp3',
-    '👻': 'sounds/nuderanjez.mp3',
-    '🪐': 'sounds/sunueversace.mp3',
+    'sMJ.mp3': '🎤',
+    'nuderanjez.mp3': '👻',
+    'sunueversace.mp3': '🪐',
 
     # Sună Telefoanele
-    '📞': 'sounds/sunatelefoanele1.mp3',
-    '👺': 'sounds/aragaz1.mp3',
-    '🫥': 'sounds/aragaz2.mp3',
-    '🤡': 'sounds/aragaz3.mp3',
+    'sunatelefoanele1.mp3': '📞',
+    'aragaz1.mp3': '👺',
+    'aragaz2.mp3': '🫥',
+    'aragaz3.mp3': '🤡',
 
     # New Sound Additions
-    '🤣': 'sounds/catlaughing.mp3',
-    '💀': 'sounds/dorianpopaciocanu.mp3',
-    '🚪': 'sounds/fbiopenup.mp3',
-    '⚡': 'sounds/hatzarf.mp3',
-    '😱': 'sounds/manscreaming.mp3',
-    '🫦': 'sounds/moan.mp3',
-    '🧔': 'sounds/petre.mp3',
-    '😴': 'sounds/snoremimimi.mp3',
-    '🍆': 'sounds/StrokinMyD.mp3',
-    '🤨': 'sounds/whathehell.mp3',
-    '🦽': 'sounds/wheelchaircripling.mp3',
-    '🤢': 'sounds/yuckbrothaeww.mp3',
-    '📱': 'sounds/nokia.mp3',
-    '🪟': 'sounds/windowsxp.mp3',
-    '💉': 'sounds/sedrogheazacucocaina.mp3',
-    '🦧': 'sounds/araticaomaimuta.mp3',
-    '🤷‍♂️': 'sounds/vreiceas.mp3',
+    'catlaughing.mp3': '🤣',
+    'dorianpopaciocanu.mp3': '💀',
+    'fbiopenup.mp3': '🚪',
+    'hatzarf.mp3': '⚡',
+    'manscreaming.mp3': '😱',
+    'moan.mp3': '🫦',
+    'petre.mp3': '🧔',
+    'snoremimimi.mp3': '😴',
+    'StrokinMyD.mp3': '🍆',
+    'whathehell.mp3': '🤨',
+    'wheelchaircripling.mp3': '🦽',
+    'yuckbrothaeww.mp3': '🤢',
+    'nokia.mp3': '📱',
+    'windowsxp.mp3': '🪟',
+    'sedrogheazacucocaina.mp3': '💉',
+    'araticaomaimuta.mp3': '🦧',
+    'vreiceas.mp3': '🤷‍♂️',
 
     # Appended New Files (previous set)
-    '🐉': 'sounds/S7thelement.mp3',
-    '🐲': 'sounds/Scrazyfrong.mp3',
-    '🦄': 'sounds/Sgangnamstyle.mp3',
-    '🌈': 'sounds/sjumatatetu.mp3',
-    '🍀': 'sounds/Sketchupsong.mp3',
-    '🚀': 'sounds/Smadeinromania.mp3',
-    '🛸': 'sounds/SmoothOperator.mp3',
-    '🧿': 'sounds/Ssaruptlantul.mp3',
-    '🎆': 'sounds/Ssmoothoperator.mp3',
-    '🌌': 'sounds/Sstayingalivebee.mp3',
+    'S7thelement.mp3': '🐉',
+    'Scrazyfrong.mp3': '🐲',
+    'Sgangnamstyle.mp3': '🦄',
+    'sjumatatetu.mp3': '🌈',
+    'Sketchupsong.mp3': '🍀',
+    'Smadeinromania.mp3': '🚀',
+    'SmoothOperator.mp3': '🛸',
+    'Ssaruptlantul.mp3': '🧿',
+    'Ssmoothoperator.mp3': '🎆',
+    'Sstayingalivebee.mp3': '🌌',
 
     # Extra New Files (the ones not already added)
-    '🕺': 'sounds/boratdisco.mp3',
-    '🎪': 'sounds/harmanem.mp3',
-    '🏃': 'sounds/staminatraining.mp3',
+    'boratdisco.mp3': '🕺',
+    'harmanem.mp3': '🎪',
+    'staminatraining.mp3': '🏃',
 }
 
 
-ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+extraction_pool = ExtractionPool(
+    ytdl_format_options,
+    workers=EXTRACTION_WORKERS,
+    max_queue=EXTRACTION_MAX_QUEUE,
+    timeout=EXTRACTION_TIMEOUT,
+)
+
+extraction_cache = ExtractionCache(
+    extraction_pool.extract,
+    max_entries=EXTRACTION_CACHE_SIZE,
+    default_ttl=EXTRACTION_CACHE_TTL,
+)
+
+search_pool = ExtractionPool(
+    ytdl_format_options,
+    workers=PLAY_SEARCH_WORKERS,
+    max_queue=PLAY_SEARCH_MAX_QUEUE,
+    timeout=EXTRACTION_TIMEOUT,
+)
+
+track_search = TrackSearch(
+    search_pool.search,
+    debounce=PLAY_SEARCH_DEBOUNCE,
+    ttl=PLAY_SEARCH_TTL,
+    max_entries=PLAY_SEARCH_CACHE_SIZE,
+)
+
+encoder_policy = EncoderPolicy(
+    music_bitrate=OPUS_MUSIC_BITRATE,
+    clip_bitrate=OPUS_CLIP_BITRATE,
+    budget=OPUS_ENCODE_BUDGET,
+    min_complexity=OPUS_MIN_COMPLEXITY,
+    max_complexity=OPUS_MAX_COMPLEXITY,
+)
+
+# One upstream connection per radio station, shared by all guilds
+radio_relays = RadioRelays(grace=RADIO_RELAY_GRACE, before_options=ffmpeg_options['before_options'])
+
+track_loudness = LoudnessStore(TRACK_LOUDNESS_STORE)
+
+media_cache = MediaCache(
+    MEDIA_CACHE_DIR,
+    max_bytes=MEDIA_CACHE_MAX_BYTES,
+    min_plays=MEDIA_CACHE_MIN_PLAYS,
+    before_options=ffmpeg_options['before_options'],
+    # Tracks are measured from their cached copy, never from the stream
+    on_cached=lambda data: track_loudness.measure(track_key(data), data),
+)
+
+
+def track_key(data):
+    return normalize_url(data.get('webpage_url') or data['url'])
+
+
+def track_gain(data):
+    """Returns the gain normalizing an extracted track, or ``None`` if it hasn't been measured yet."""
+    loudness = track_loudness.get(track_key(data))
+    if loudness is None:
+        return None
+    return loudness.gain(LOUDNESS_TARGET, LOUDNESS_MAX_PEAK, LOUDNESS_TOLERANCE)
+
+
+def search_choice_name(result):
+    """Labels a search result for autocomplete, which allows 100 characters."""
+    title = result['title'] or result['url']
+    duration = result.get('duration')
+    suffix = f' ({int(duration) // 60}:{int(duration) % 60:02d})' if duration else ''
+    if len(title) + len(suffix) > 100:
+        title = title[:99 - len(suffix)] + '…'
+    return title + suffix
+
+
+def open_pcm(url, *, local=False):
+    """Opens ``url`` as a PCM source with the configured decoding backend."""
+    # Local files don't take the stream's reconnect options
+    before_options = None if local else ffmpeg_options['before_options']
+    if AUDIO_BACKEND == 'av':
+        return av_audio.AVAudioSource(url, options=av_audio.input_options(before_options))
+    return discord.FFmpegPCMAudio(url, before_options=before_options, options=ffmpeg_options['options'])
 
 class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
+    def __init__(self, source, *, data, volume=1.0):
         super().__init__(source, volume)
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
 
-    @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+    @property
+    def started(self):
+        # PyAV sources read silence while they open, the mixer waits for this before calling on_start
+        return getattr(self.original, 'started', True)
 
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
+    @classmethod
+    def from_data(cls, data):
+        """Opens a stream for an already extracted track, at its normalized volume if it's known."""
+        # Unmeasured tracks play as they are, whichever path they take
+        gain = track_gain(data)
+        if gain is None:
+            gain = 1.0
+        if data.get('local') and data.get('acodec') == 'opus':
+            return media_cache.source(data, gain=gain)
+        if data.get('local'):
+            # A music library file in some other format
+            return cls(open_pcm(data['url'], local=True), data=data, volume=gain)
+        if OPUS_PASSTHROUGH and data.get('acodec') == 'opus':
+            return YTDLOpusSource(data, gain=gain)
+        return cls(open_pcm(data['url']), data=data, volume=gain)
+
+class YTDLOpusSource(discord.FFmpegOpusAudio):
+    """Remuxes a stream that already is opus and sends its packets as they are.
+
+    No volume control of its own: ``gain`` is applied by the mixer, which
+    then has to decode it, so it's only set when the track is noticeably off
+    the loudness target.
+    """
+    def __init__(self, data, *, gain=1.0):
+        super().__init__(data['url'], codec='copy', **ffmpeg_options)
+        self.data = data
+        self.gain = gain
+        self.title = data.get('title')
+        self.url = data.get('url')
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+def source_backend(source):
+    """Names what decodes ``source``, for the startup time metric."""
+    if source.data.get('extractor') == 'library':
+        return 'library'
+    if isinstance(source, CachedTrackAudio):
+        return 'media_cache'
+    if isinstance(source, YTDLOpusSource):
+        return 'ffmpeg_copy'
+    if isinstance(getattr(source, 'original', None), av_audio.AVAudioSource):
+        return 'av'
+    return 'ffmpeg'
+
+def log_failure(future):
+    """Done callback logging the exception of a future nothing else awaits."""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Background task failed', exc_info=future.exception())
 
 def ensure_voice_connection(func):
     """Decorator to ensure the bot is connected to the user's voice channel before executing the command."""
@@ -228,11 +489,29 @@ def ensure_voice_connection(func):
         if interaction.user.voice is None:
             await interaction.response.send_message("You are not connected to a voice channel.", ephemeral=True)
             return
-        if interaction.guild.voice_client is None:
-            await interaction.user.voice.channel.connect()
+        sessions = interaction.client.voice_sessions
+        sessions.record_use(interaction.user.id)
+        # Reuses the guild's connection if there is one, even in another channel
+        await sessions.ensure(interaction.user.voice.channel)
         return await func(self, interaction, *args, **kwargs)
     return wrapper
 
+class SoundButton(Button):
+    """A soundboard button, re-pointed at another sound when the page changes."""
+    def __init__(self):
+        super().__init__(style=discord.ButtonStyle.primary)
+        self.sound = None
+
+    def show(self, sound):
+        self.sound = sound
+        self.emoji = sound.emoji
+        self.label = None if sound.emoji else sound.label
+
+    async def callback(self, interaction: discord.Interaction):
+        on_start = observe_since(FIRST_AUDIO, time.perf_counter(), 'soundboard')
+        await interaction.response.defer(ephemeral=True)
+        await self.view.music_cog.play_sound(self.view.voice_client, self.sound, on_start=on_start)
+
 class PaginatedSoundboardView(View):
     def __init__(self, voice_client, music_cog, page=0):
         super().__init__(timeout=60)
@@ -240,72 +519,51 @@ class PaginatedSoundboardView(View):
         self.music_cog = music_cog
         self.page = page
         self.items_per_page = 20  # Leave room for navigation buttons
-        self.total_pages = (len(music_cog.soundboard_mapping) - 1) // self.items_per_page + 1
-        
-        # Get items for current page
-        items = list(music_cog.soundboard_mapping.items())
-        start_idx = self.page * self.items_per_page
-        end_idx = start_idx + self.items_per_page
-        current_page_items = items[start_idx:end_idx]
-
-        # Add sound buttons for current page
-        for emoji, file_path in current_page_items:
-            button = Button(emoji=emoji, style=discord.ButtonStyle.primary)
-            button.callback = self.make_sound_callback(file_path)
-            self.add_item(button)
 
-        # Add navigation buttons
-        if self.total_pages > 1:
-            # Previous page button
-            prev_button = Button(
-                emoji="⬅️", 
-                style=discord.ButtonStyle.secondary,
-                disabled=self.page == 0
-            )
-            prev_button.callback = self.previous_page
-            self.add_item(prev_button)
-
-            # Page indicator button (non-functional, just shows current page)
-            page_indicator = Button(
-                label=f"Page {self.page + 1}/{self.total_pages}",
-                style=discord.ButtonStyle.secondary,
-                disabled=True
-            )
-            self.add_item(page_indicator)
+        # Buttons are created once and re-pointed on every page turn
+        self.sound_buttons = [SoundButton() for _ in range(self.items_per_page)]
 
-            # Next page button
-            next_button = Button(
-                emoji="➡️",
-                style=discord.ButtonStyle.secondary,
-                disabled=self.page == self.total_pages - 1
-            )
-            next_button.callback = self.next_page
-            self.add_item(next_button)
+        # Previous page button
+        self.prev_button = Button(
+            emoji="⬅️", 
+            style=discord.ButtonStyle.secondary
+        )
+        self.prev_button.callback = self.previous_page
 
-    def make_sound_callback(self, file_path):
-        async def play_sound(interaction: discord.Interaction):
-            await interaction.response.defer(ephemeral=True)
+        # Page indicator button (non-functional, just shows current page)
+        self.page_indicator = Button(
+            style=discord.ButtonStyle.secondary,
+            disabled=True
+        )
 
-            # Save the current YouTube audio state
-            guild_id = interaction.guild.id
-            if self.voice_client.is_playing() and guild_id in self.music_cog.current_youtube_source:
-                self.music_cog.was_youtube_playing[guild_id] = True
-                self.voice_client.pause()
-            else:
-                self.music_cog.was_youtube_playing[guild_id] = False
+        # Next page button
+        self.next_button = Button(
+            emoji="➡️",
+            style=discord.ButtonStyle.secondary
+        )
+        self.next_button.callback = self.next_page
 
-            def after_playback(e):
-                if e:
-                    logger.error(f"Soundboard playback error: {e}")
-                if self.music_cog.was_youtube_playing.get(guild_id, False):
-                    self.voice_client.play(self.music_cog.current_youtube_source[guild_id], after=None)
+        self.show_page()
 
-            self.voice_client.play(
-                discord.FFmpegPCMAudio(file_path),
-                after=after_playback
-            )
+    def show_page(self):
+        # Page layouts are computed once per sound index, not on every turn
+        pages = self.music_cog.sound_index.pages(self.items_per_page)
+        self.total_pages = len(pages)
+        self.page = min(self.page, self.total_pages - 1)
 
-        return play_sound
+        self.clear_items()
+        for button, sound in zip(self.sound_buttons, pages[self.page]):
+            button.show(sound)
+            self.add_item(button)
+
+        # Add navigation buttons
+        if self.total_pages > 1:
+            self.prev_button.disabled = self.page == 0
+            self.page_indicator.label = f"Page {self.page + 1}/{self.total_pages}"
+            self.next_button.disabled = self.page == self.total_pages - 1
+            self.add_item(self.prev_button)
+            self.add_item(self.page_indicator)
+            self.add_item(self.next_button)
 
     async def previous_page(self, interaction: discord.Interaction):
         self.page = max(0, self.page - 1)
@@ -316,14 +574,10 @@ class PaginatedSoundboardView(View):
         await self.update_view(interaction)
 
     async def update_view(self, interaction: discord.Interaction):
-        new_view = PaginatedSoundboardView(
-            self.voice_client,
-            self.music_cog,
-            self.page
-        )
+        self.show_page()
         await interaction.response.edit_message(
             content=f"Choose a sound to play (Page {self.page + 1}/{self.total_pages}):",
-            view=new_view
+            view=self
         )
 
 class RadioView(View):
@@ -383,15 +637,12 @@ class RadioView(View):
         self.add_item(prog_button)
 
     async def play_radio(self, interaction: discord.Interaction, url: str, radio_name: str):
+        on_start = observe_since(FIRST_AUDIO, time.perf_counter(), 'radio')
         await interaction.response.defer(ephemeral=True)
         try:
-            if self.voice_client.is_playing():
-                self.voice_client.stop()
-            
-            self.voice_client.play(
-                discord.FFmpegPCMAudio(url, **ffmpeg_options)
-            )
-            self.music_cog.current_youtube_source[interaction.guild.id] = self.voice_client.source
+            source = radio_relays.subscribe(url)
+            self.music_cog.play_music(self.voice_client, source, on_start=on_start)
+            self.music_cog.get_state(interaction.guild.id).now_playing = TrackRecord(radio_name, url)
             
             await interaction.followup.send(f'Now playing: {radio_name} 🎶', ephemeral=True)
         except Exception as e:
@@ -445,38 +696,417 @@ class RadioView(View):
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.soundboard_mapping = SOUNDBOARD_MAPPING
-        self.current_youtube_source = {}  # To store the current YouTube audio source per guild
-        self.was_youtube_playing = {}  # To track if YouTube audio was playing before soundboard
-
-    @discord.app_commands.command(name="play", description="Plays from a URL")
-    @discord.app_commands.describe(url="The URL to play from")
+        self.sound_index = SoundIndex.load(SOUNDS_DIR, SOUND_MANIFEST)
+        self.music_library = MusicLibrary.load(MUSIC_LIBRARY_DIR, MUSIC_LIBRARY_INDEX) if MUSIC_LIBRARY_DIR \
+            else MusicLibrary('.', [])
+        self.guilds = {}  # GuildState per guild with something playing or queued
+        self.opus_cache = OpusClipCache(OPUS_CACHE_DIR, max_bytes=OPUS_CACHE_MAX_BYTES)
+        self.sound_commands = set()  # Names of the registered !N commands
+
+    async def cog_load(self):
+        self.sync_sound_commands()
+        self.rescan_sounds.start()
+        if MUSIC_LIBRARY_DIR:
+            self.rescan_library.start()
+        self.release_idle_guilds.start()
+
+    async def cog_unload(self):
+        self.rescan_sounds.cancel()
+        self.rescan_library.cancel()
+        self.release_idle_guilds.cancel()
+        for name in self.sound_commands:
+            self.bot.remove_command(name)
+        self.sound_commands = set()
+        for guild_id in list(self.guilds):
+            self.release(guild_id)
+
+    @tasks.loop(seconds=60)
+    async def release_idle_guilds(self):
+        for guild_id, state in list(self.guilds.items()):
+            guild = self.bot.get_guild(guild_id)
+            voice_client = guild.voice_client if guild else None
+            if voice_client is None:
+                self.release(guild_id)
+            elif voice_client.is_playing() or state.queue.entries:
+                state.touch()
+            elif state.idle_for() > GUILD_IDLE_TIMEOUT:
+                self.release(guild_id)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if member.id == self.bot.user.id and after.channel is None:
+            self.release(member.guild.id)
+
+    def get_state(self, guild_id):
+        state = self.guilds.get(guild_id)
+        if state is None:
+            queue = GuildQueue(
+                self.resolve_track,
+                prefetch=PREFETCH_TRACKS,
+                open_source=YTDLSource.from_data if PREFETCH_PIPELINES else None,
+            )
+            state = self.guilds[guild_id] = GuildState(guild_id, queue)
+        return state
+
+    def now_playing(self, guild_id):
+        state = self.guilds.get(guild_id)
+        return state.now_playing if state is not None else None
+
+    def release(self, guild_id):
+        """Drops a guild's queue and playback state."""
+        state = self.guilds.pop(guild_id, None)
+        if state is not None:
+            state.release()
+            logger.debug('Released the state of guild %s', guild_id)
+
+    @tasks.loop(seconds=SOUND_RESCAN_INTERVAL)
+    async def rescan_sounds(self):
+        try:
+            await self.refresh_sounds()
+        except Exception:
+            logger.exception('Rescanning %s failed', SOUNDS_DIR)
+
+    async def refresh_sounds(self):
+        """Rescans the sounds directory off the event loop and swaps in the new index if anything changed."""
+        loop = asyncio.get_running_loop()
+        previous = self.sound_index
+        if SHARD_WORKER is not None:
+            # The supervisor scans, workers only pick up the manifest it wrote
+            index = await loop.run_in_executor(None, SoundIndex.load, SOUNDS_DIR, SOUND_MANIFEST)
+        else:
+            index = await loop.run_in_executor(None, lambda: scan(SOUNDS_DIR, previous, emojis=SOUND_EMOJIS))
+        if index.rows() == previous.rows():
+            return previous
+        # Build the search index off the event loop as well
+        await loop.run_in_executor(None, lambda: index.search)
+
+        self.sound_index = index
+        self.sync_sound_commands()
+        logger.info('Sound index updated: %d sounds', len(index))
+        if SHARD_WORKER is None:
+            await loop.run_in_executor(None, index.save, SOUND_MANIFEST)
+        await self.opus_cache.warm([sound.path for sound in index])
+        return index
+
+    @tasks.loop(seconds=MUSIC_LIBRARY_RESCAN_INTERVAL)
+    async def rescan_library(self):
+        try:
+            await self.refresh_library()
+        except Exception:
+            logger.exception('Rescanning %s failed', MUSIC_LIBRARY_DIR)
+
+    async def refresh_library(self):
+        """Rescans the music library off the event loop and swaps in the new index if anything changed."""
+        loop = asyncio.get_running_loop()
+        previous = self.music_library
+        if SHARD_WORKER is not None:
+            # The supervisor scans, workers only pick up the index it wrote
+            library = await loop.run_in_executor(None, MusicLibrary.load, MUSIC_LIBRARY_DIR, MUSIC_LIBRARY_INDEX)
+        else:
+            library = await loop.run_in_executor(None, scan_library, MUSIC_LIBRARY_DIR, previous)
+        if library.rows() == previous.rows():
+            return previous
+        await loop.run_in_executor(None, lambda: library.search)
+
+        self.music_library = library
+        logger.info('Music library updated: %d tracks', len(library))
+        if SHARD_WORKER is None:
+            await loop.run_in_executor(None, library.save, MUSIC_LIBRARY_INDEX)
+        return library
+
+    def sync_sound_commands(self):
+        """Registers a ``!N`` prefix command per numbered sound and drops the ones no sound has anymore."""
+        wanted = {str(number) for number in self.sound_index.numbers}
+        for name in self.sound_commands - wanted:
+            self.bot.remove_command(name)
+        for name in wanted - self.sound_commands:
+            self.bot.add_command(self.numbered_sound_command(int(name)))
+        self.sound_commands = wanted
+
+    def numbered_sound_command(self, number):
+        async def command(ctx):
+            await self.play_numbered(ctx, number)
+        return commands.Command(command, name=str(number), hidden=True)
+
+    async def play_numbered(self, ctx, number):
+        """Plays the sound numbered ``number`` in the author's voice channel, for the ``!N`` commands."""
+        started = time.perf_counter()
+        # Looked up at play time, the command outlives index swaps
+        sound = self.sound_index.numbers.get(number)
+        if sound is None:
+            return await ctx.send("Sound file not found.")
+        voice = getattr(ctx.author, 'voice', None)
+        if voice is None or voice.channel is None:
+            return await ctx.send("Join a voice channel to play sounds.")
+        sessions = self.bot.voice_sessions
+        sessions.record_use(ctx.author.id)
+        voice_client = await sessions.ensure(voice.channel, move=True)
+        await self.play_sound(voice_client, sound, on_start=observe_since(FIRST_AUDIO, started, 'prefix'))
+
+    async def play_sound(self, voice_client, sound, *, on_start=None):
+        """Plays a soundboard clip from the opus cache, at its normalized volume, over whatever is playing."""
+        def after_playback(e):
+            if e:
+                logger.error(f"Soundboard playback error: {e}")
+
+        # Clips are mixed over whatever is playing instead of pausing it
+        source = await self.opus_cache.source(sound.path)
+        volume = sound.gain(LOUDNESS_TARGET, LOUDNESS_MAX_PEAK, LOUDNESS_TOLERANCE)
+        self.play_clip(voice_client, source, volume=volume, after=after_playback, on_start=on_start)
+
+    @staticmethod
+    def active_mixer(voice_client):
+        """Returns the mixer currently feeding ``voice_client``, if any."""
+        source = voice_client.source if voice_client else None
+        if isinstance(source, MixerSource) and not source.closed:
+            return source
+        return None
+
+    def mix(self, voice_client, add_layer):
+        """Calls ``add_layer(mixer)`` on the guild's mixer, starting a new mixer if none is running."""
+        current = voice_client.source if voice_client.is_playing() or voice_client.is_paused() else None
+        if isinstance(current, MixerSource) and add_layer(current):
+            return current
+
+        mixer = MixerSource(max_voices=MIXER_MAX_VOICES)
+        add_layer(mixer)
+        # Set before the player thread sees the mixer; play() leaves it alone as the mixer starts out as opus
+        voice_client.encoder = encoder_policy.encoder(voice_client, mixer, voice_client.encoder)
+        if current is not None and not isinstance(current, MixerSource):
+            # Hand whatever is playing over to the mixer so it keeps going underneath
+            mixer.add_clip(current)
+            voice_client.source = mixer
+            return mixer
+        if current is not None:
+            voice_client.stop()
+        voice_client.play(mixer, after=lambda e: logger.error(f'Mixer error: {e}') if e else None)
+        return mixer
+
+    def play_music(self, voice_client, source, *, volume=1.0, after=None, track=None, on_start=None):
+        """Replaces the music layer of the guild's mixer, leaving clips playing."""
+        # Whatever was playing is replaced, its end must not advance the queue
+        state = self.get_state(voice_client.guild.id)
+        state.queue.current = track
+        state.touch()
+        mixer = self.mix(voice_client, lambda m: m.set_music(source, volume=volume, after=after, on_start=on_start))
+        if voice_client.is_paused():
+            voice_client.resume()
+        return mixer
+
+    def play_clip(self, voice_client, source, *, volume=1.0, after=None, on_start=None):
+        """Overlays a clip on whatever the guild is playing."""
+        mixer = self.mix(voice_client, lambda m: m.add_clip(source, volume=volume, after=after, on_start=on_start))
+        if voice_client.is_paused():
+            voice_client.resume()
+        return mixer
+
+    def get_queue(self, guild_id):
+        return self.get_state(guild_id).queue
+
+    def find_queue(self, guild_id):
+        """Returns the guild's queue without creating any state for it."""
+        state = self.guilds.get(guild_id)
+        return state.queue if state is not None else None
+
+    async def resolve_track(self, query):
+        """Returns the info dict to play ``query`` from, the local copy if the media cache has one."""
+        if query.startswith(LIBRARY_SCHEME):
+            track = self.music_library.get(query)
+            if track is None:
+                raise FileNotFoundError(f'{query} is no longer in the music library')
+            return track.data()
+        data = media_cache.lookup(query)
+        if data is not None:
+            return data
+        return await extraction_cache.get(query)
+
+    async def make_entry(self, query, requester, *, name=None):
+        """Returns what to queue for ``query``: a single track or a lazily expanded playlist."""
+        if query.startswith(LIBRARY_SCHEME):
+            track = self.music_library.get(query)
+            return QueuedTrack(query, requester, name=track.label if track is not None else name)
+        key = normalize_url(query)
+        if key.startswith(('search:', 'youtube:')) or extraction_cache.get_cached(key) is not None \
+                or media_cache.lookup(query, peek=True) is not None:
+            return QueuedTrack(query, requester, name=name)
+
+        page = await extraction_pool.extract_page(query, 1, PLAYLIST_PAGE_SIZE)
+        if 'entries' not in page:
+            # A single track, the flat extraction already resolved it
+            extraction_cache.put(key, page)
+            return QueuedTrack(query, requester)
+        if 'first' in page:
+            extraction_cache.put(normalize_url(page['entries'][0]['url']), page['first'])
+        entries = iter_playlist(extraction_pool, query, page_size=PLAYLIST_PAGE_SIZE, first_page=page)
+        return LazyPlaylist(page['title'], entries, requester)
+
+    async def play_next(self, guild, *, on_start=None):
+        """Starts the next track of the guild's queue. Returns it, or ``None`` if the queue ran out.
+
+        ``on_start`` is called from the audio thread once the track's first frame plays.
+        """
+        state = self.get_state(guild.id)
+        queue = state.queue
+        async with queue.lock:
+            while True:
+                track = await queue.next()
+                voice_client = guild.voice_client
+                if track is None or voice_client is None:
+                    if track is not None:
+                        track.cancel()
+                    queue.current = None
+                    state.now_playing = None
+                    return None
+
+                # Use the pipeline the prefetcher already opened, if any
+                source = track.source
+                track.source = None
+                callbacks = [on_start] if on_start is not None else []
+                if source is not None:
+                    break
+                opened = time.perf_counter()
+                try:
+                    source = YTDLSource.from_data(track.data)
+                except Exception as e:
+                    # Its file went away or ffmpeg didn't start, the queue moves on without it
+                    track.error = e
+                    logger.warning('Skipping %r, its audio could not be opened: %s', track.query, e)
+                    queue.current = None
+                    state.now_playing = None
+                    continue
+                callbacks.append(observe_since(SOURCE_STARTUP, opened, source_backend(source)))
+                break
+            # Passed-through opus can't carry its own volume, the mixer applies it
+            volume = source.gain if isinstance(source, (YTDLOpusSource, CachedTrackAudio)) else 1.0
+            self.play_music(
+                voice_client, source, volume=volume, track=track,
+                after=lambda e: self.track_finished(guild, track, e),
+                on_start=lambda: [callback() for callback in callbacks],
+            )
+            state.now_playing = TrackRecord.from_data(track.data)
+            # Library and cached files are measured once in the background, their next play is normalized
+            track_loudness.measure(track_key(track.data), track.data)
+            media_cache.record_play(track.query, track.data)
+            return track
+
+    def track_finished(self, guild, track, error):
+        """Called from the audio thread when a queued track's music layer ends."""
+        if error:
+            logger.error(f'Player error: {error}')
+        queue = self.find_queue(guild.id)
+        if queue is not None and queue.current is track:
+            future = asyncio.run_coroutine_threadsafe(self.play_next(guild), self.bot.loop)
+            future.add_done_callback(log_failure)
+
+    @discord.app_commands.command(name="play", description="Plays from a URL or a search")
+    @discord.app_commands.describe(url="The URL to play from, or what to search for")
     @ensure_voice_connection
     async def play(self, interaction: discord.Interaction, url: str):
-        """Streams audio from a URL"""
+        """Streams audio from a URL, or queues it if something is already playing"""
+        started = time.perf_counter()
         await interaction.response.defer(ephemeral=True)
+        queue = self.get_queue(interaction.guild.id)
+        name = None
+        if normalize_url(url).startswith('search:'):
+            # Typed without picking a suggestion: the library comes first, then the results shown for it
+            track = self.music_library.match(url)
+            result = track_search.lookup(url) if track is None else {'url': track.key, 'title': track.label}
+            if result is not None:
+                url, name = result['url'], result['title']
         try:
-            player = await YTDLSource.from_url(url, loop=self.bot.loop, stream=True)
-            voice_client = interaction.guild.voice_client
-            if voice_client and voice_client.is_playing():
-                voice_client.stop()
-            
-            voice_client.play(player, after=lambda e: print(f'Player error: {e}') if e else None)
-            self.current_youtube_source[interaction.guild.id] = player
-            await interaction.followup.send(f'Now streaming: {player.title}', ephemeral=True)
+            entry = await self.make_entry(url, interaction.user.id, name=name)
+            if queue.current is not None or queue.entries or queue.lock.locked():
+                position = queue.add(entry)
+                await interaction.followup.send(f'Queued at position {position}: {entry.title}', ephemeral=True)
+                return
+
+            queue.add(entry)
+            track = await self.play_next(interaction.guild, on_start=observe_since(FIRST_AUDIO, started, 'play'))
+            if track is not None:
+                await interaction.followup.send(f'Now streaming: {track.title}', ephemeral=True)
+            elif isinstance(getattr(entry, 'error', None), ExtractionBusy):
+                await interaction.followup.send("Too many requests are being looked up right now, try again in a bit.", ephemeral=True)
+            else:
+                await interaction.followup.send("Failed to stream the requested URL.", ephemeral=True)
+        except ExtractionBusy:
+            await interaction.followup.send("Too many requests are being looked up right now, try again in a bit.", ephemeral=True)
         except Exception as e:
             logger.exception('Error in stream command: %s', str(e))
             await interaction.followup.send("Failed to stream the requested URL.", ephemeral=True)
 
+    @play.autocomplete('url')
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str):
+        if not normalize_url(current).startswith('search:'):
+            return []  # Already a URL
+        library = [
+            app_commands.Choice(name=f'📁 {track.label}'[:100], value=track.key)
+            for track in self.music_library.matches(current) if len(track.key) <= 100
+        ]
+        if library:
+            return library  # Answered right away, no need to search online
+        # Each value is the video's own URL, so playing it skips the search
+        return [
+            app_commands.Choice(name=search_choice_name(result), value=result['url'])
+            for result in await track_search.suggest(interaction.user.id, current)
+            if len(result['url']) <= 100
+        ][:25]
+
+    @discord.app_commands.command(name="queue", description="Shows the upcoming tracks")
+    async def queue(self, interaction: discord.Interaction):
+        """Lists the current track and the next entries of the queue"""
+        queue = self.find_queue(interaction.guild.id)
+        if queue is None or (queue.current is None and not queue.entries):
+            await interaction.response.send_message("The queue is empty.", ephemeral=True)
+            return
+
+        lines = []
+        if queue.current is not None:
+            lines.append(f'Now playing: {queue.current.title}')
+        for position, track in enumerate(list(queue.entries)[:QUEUE_PAGE_SIZE], start=1):
+            lines.append(f'{position}. {track.title}')
+        if len(queue.entries) > QUEUE_PAGE_SIZE:
+            lines.append(f'...and {len(queue.entries) - QUEUE_PAGE_SIZE} more')
+        await interaction.response.send_message('\n'.join(lines), ephemeral=True)
+
+    @discord.app_commands.command(name="skip", description="Skips to the next track in the queue")
+    @ensure_voice_connection
+    async def skip(self, interaction: discord.Interaction):
+        """Stops the current track, the queue moves on by itself"""
+        queue = self.find_queue(interaction.guild.id)
+        mixer = self.active_mixer(interaction.guild.voice_client)
+        if queue is not None and queue.current is not None and mixer and mixer.music is not None:
+            mixer.stop_music()
+            await interaction.response.send_message("Skipped.", ephemeral=True)
+        elif queue is not None and queue.entries:
+            await interaction.response.defer(ephemeral=True)
+            track = await self.play_next(interaction.guild)
+            await interaction.followup.send(f'Now streaming: {track.title}' if track else "Nothing left to play.", ephemeral=True)
+        else:
+            await interaction.response.send_message("Nothing to skip.", ephemeral=True)
+
+    @discord.app_commands.command(name="remove", description="Removes a track from the queue")
+    @discord.app_commands.describe(position="Position of the track in /queue")
+    async def remove(self, interaction: discord.Interaction, position: int):
+        """Removes a queued track by its position"""
+        queue = self.find_queue(interaction.guild.id)
+        if queue is None or not 1 <= position <= len(queue.entries):
+            await interaction.response.send_message("There is no track at that position.", ephemeral=True)
+            return
+        track = queue.remove(position - 1)
+        await interaction.response.send_message(f'Removed: {track.title}', ephemeral=True)
+
     @discord.app_commands.command(name="resume", description="Resumes paused audio playback")
     @ensure_voice_connection
     async def resume(self, interaction: discord.Interaction):
         """Resumes the currently paused YouTube audio"""
         voice_client = interaction.guild.voice_client
         guild_id = interaction.guild.id
-        if voice_client and voice_client.is_paused():
-            if guild_id in self.current_youtube_source:
-                voice_client.resume()
+        mixer = self.active_mixer(voice_client)
+        if mixer and mixer.music_paused:
+            if self.now_playing(guild_id) is not None:
+                mixer.resume_music()
+                if voice_client.is_paused():
+                    voice_client.resume()
                 await interaction.response.send_message("Playback resumed.", ephemeral=True)
             else:
                 await interaction.response.send_message("Cannot resume non-YouTube playback.", ephemeral=True)
@@ -489,8 +1119,12 @@ class Music(commands.Cog):
         """Pauses the currently playing YouTube audio"""
         voice_client = interaction.guild.voice_client
         guild_id = interaction.guild.id
-        if voice_client and voice_client.is_playing() and guild_id in self.current_youtube_source:
-            voice_client.pause()
+        mixer = self.active_mixer(voice_client)
+        if mixer and mixer.music is not None and not mixer.music_paused and self.now_playing(guild_id) is not None:
+            # Only the music is paused, soundboard clips can still play over the silence
+            mixer.pause_music()
+            if not mixer.clips:
+                voice_client.pause()
             await interaction.response.send_message("Playback paused.", ephemeral=True)
         else:
             await interaction.response.send_message("No YouTube audio is currently playing.", ephemeral=True)
@@ -502,55 +1136,208 @@ class Music(commands.Cog):
         view = PaginatedSoundboardView(interaction.guild.voice_client, self)
         await interaction.response.send_message("Choose a sound to play:", view=view, ephemeral=True)
 
+    @discord.app_commands.command(name="sound", description="Play a soundboard sound by name")
+    @discord.app_commands.describe(query="Name or tag of the sound")
+    @ensure_voice_connection
+    async def sound(self, interaction: discord.Interaction, query: str):
+        """Plays the sound picked from autocomplete, or the best match for the query"""
+        started = time.perf_counter()
+        index = self.sound_index
+        match = index.get(query)
+        if match is None and query.startswith('!') and query[1:].isdigit():
+            # Autocomplete picks are sent as the sound's number, names can be too long for a choice
+            match = index.numbers.get(int(query[1:]))
+        if match is None:
+            results = index.search.search(query, limit=1)
+            match = results[0] if results else None
+        if match is None:
+            await interaction.response.send_message("No sound matches that.", ephemeral=True)
+            return
+        await interaction.response.send_message(f'Playing {match.label}', ephemeral=True)
+        await self.play_sound(interaction.guild.voice_client, match, on_start=observe_since(FIRST_AUDIO, started, 'sound'))
+
+    @sound.autocomplete('query')
+    async def sound_autocomplete(self, interaction: discord.Interaction, current: str):
+        index = self.sound_index
+        return [
+            app_commands.Choice(
+                name=(f'{sound.emoji} {sound.label}' if sound.emoji else sound.label)[:100],
+                value=f'!{index.number_of[sound.name]}',
+            )
+            for sound in index.search.search(current, limit=25)
+        ]
+
     @discord.app_commands.command(name="radio", description="Play Ibiza Global Radio stations")
     @ensure_voice_connection
     async def radio(self, interaction: discord.Interaction):
         """Displays radio station buttons and plays selected station"""
         view = RadioView(interaction.guild.voice_client, self)
         await interaction.response.send_message("Choose a radio station:", view=view, ephemeral=True)
+
+    @discord.app_commands.command(name="memory", description="Shows how much memory the bot uses per guild")
+    @discord.app_commands.default_permissions(administrator=True)
+    async def memory(self, interaction: discord.Interaction):
+        """Reports process RSS, shared caches and the biggest per-guild states"""
+        rss = process_rss()
+        usage = sorted(((state.memory_usage(), guild_id) for guild_id, state in self.guilds.items()), reverse=True)
+        lines = [
+            f'RSS: {rss / 1024 ** 2:.1f} MiB' if rss is not None else 'RSS: unknown',
+            f'Guild states: {len(self.guilds)}, {sum(size for size, _ in usage) / 1024:.1f} KiB',
+            f'Opus clip cache: {self.opus_cache.memory_usage / 1024 ** 2:.1f} MiB',
+            f'Extraction cache: {len(extraction_cache)} entries',
+            f'Media cache: {len(media_cache.tracks)} tracks, {media_cache.disk_usage / 1024 ** 2:.1f} MiB on disk',
+        ]
+        for size, guild_id in usage[:10]:
+            guild = self.bot.get_guild(guild_id)
+            lines.append(f'- {guild.name if guild else guild_id}: {size / 1024:.1f} KiB, {len(self.guilds[guild_id].queue)} queued')
+        await interaction.response.send_message('\n'.join(lines), ephemeral=True)
             
 class Somalezu(commands.Bot):
-    def __init__(self, *, command_prefix, description, intents):
-        super().__init__(command_prefix=command_prefix, intents=intents, description=description)
+    def __init__(self, *, command_prefix, description, intents, **options):
+        super().__init__(command_prefix=command_prefix, intents=intents, description=description, **options)
+        self.voice_sessions = VoiceSessions(
+            self, idle_timeout=VOICE_IDLE_TIMEOUT, preconnect_after=VOICE_PRECONNECT_USES,
+        )
+        self.metrics_runner = None
+        self.loop_watchdog = None
+        if LOOP_BLOCK_THRESHOLD > 0:
+            self.loop_watchdog = LoopWatchdog(interval=LOOP_WATCHDOG_INTERVAL, threshold=LOOP_BLOCK_THRESHOLD)
 
     async def setup_hook(self):
+        if self.loop_watchdog is not None:
+            self.loop_watchdog.start()
+        await extraction_pool.start()
+        await search_pool.start()
+        self.voice_sessions.start()
+        track_loudness.load()
+        await self.loop.run_in_executor(None, media_cache.load)
         music_cog = Music(self)
         await self.add_cog(music_cog)
+        metrics.track_cache('opus_clips', music_cog.opus_cache)
+        metrics.track_cache('extraction', extraction_cache)
+        metrics.track_cache('media', media_cache)
+        metrics.track_cache('play_search', track_search)
+        if METRICS_PORT:
+            # Each shard worker serves its own port, counting up from METRICS_PORT
+            self.metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT + int(SHARD_WORKER or 0))
+        # Encode soundboard clips in the background so the first press doesn't wait on ffmpeg
+        self.loop.create_task(music_cog.opus_cache.warm([sound.path for sound in music_cog.sound_index]))
         self.tree.copy_global_to(guild=MY_GUILD)
-        await self.tree.sync(guild=MY_GUILD)
+        if SHARD_WORKER in (None, '0'):
+            # Commands are the same everywhere, one worker syncing them is enough
+            await self.tree.sync(guild=MY_GUILD)
+
+    async def close(self):
+        if self.loop_watchdog is not None:
+            self.loop_watchdog.close()
+        self.voice_sessions.close()
+        await extraction_pool.close()
+        await search_pool.close()
+        radio_relays.close()
+        track_loudness.close()
+        media_cache.close()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
 
     async def on_message(self, message):
         if message.author.bot:
             return
         if self.user.mentioned_in(message) and not message.mention_everyone:
             if message.author.voice:
-                voice_channel = message.author.voice.channel
-                voice_client = message.guild.voice_client
-                if voice_client is None:
-                    await voice_channel.connect()
-                elif voice_channel != voice_client.channel:
-                    await voice_client.move_to(voice_channel)
+                self.voice_sessions.record_use(message.author.id)
+                await self.voice_sessions.ensure(message.author.voice.channel, move=True)
             else:
                 await message.channel.send("You need to be in a voice channel to summon me!")
         await self.process_commands(message)
 
+    async def on_voice_state_update(self, member, before, after):
+        await self.voice_sessions.on_voice_state_update(member, before, after)
+
+    async def on_command_error(self, context, exception):
+        if isinstance(exception, commands.CommandNotFound):
+            return  # Plenty of chat messages start with "!" without meaning a command
+        await super().on_command_error(context, exception)
+
     async def on_ready(self):
         print(f'Logged in as {self.user} (ID: {self.user.id})')
         print('------',TOKEN)
         print('------')
 
-async def main():
+class ShardedSomalezu(Somalezu, commands.AutoShardedBot):
+    """Somalezu running a subset of the bot's shards, as one worker of the sharded mode."""
+
+async def main(*, shard_ids=None, shard_count=None):
     intents = discord.Intents.default()
     intents.message_content = True
-    bot = Somalezu(
-        command_prefix=commands.when_mentioned_or("/"),
+    options = {}
+    bot_class = Somalezu
+    if shard_ids is not None:
+        bot_class = ShardedSomalezu
+        options = {'shard_ids': shard_ids, 'shard_count': shard_count}
+    bot = bot_class(
+        command_prefix=commands.when_mentioned_or("/", "!"),
         description='Assflute enjoyer',
         intents=intents,
+        **options,
     )
     try:
         await bot.start(TOKEN)
     finally:
         await bot.close()
 
+def refresh_shared_sounds():
+    """Supervisor side of the sharded mode: scans the sounds once for every worker.
+
+    Writes the manifest the workers load and puts every clip in the shared
+    disk cache, so no worker has to run ffmpeg for them.
+    """
+    previous = SoundIndex.load(SOUNDS_DIR, SOUND_MANIFEST)
+    index = scan(SOUNDS_DIR, previous, emojis=SOUND_EMOJIS)
+    if index.rows() != previous.rows():
+        index.save(SOUND_MANIFEST)
+    opus_cache = OpusClipCache(OPUS_CACHE_DIR)
+    for sound in index:
+        try:
+            opus_cache.encode_to_disk(sound.path, sound.digest)
+        except Exception as e:
+            logger.warning('Could not pre-encode %s: %s', sound.path, e)
+
+def refresh_shared_library():
+    """Supervisor side of the sharded mode: indexes the music library once and writes it for every worker."""
+    previous = MusicLibrary.load(MUSIC_LIBRARY_DIR, MUSIC_LIBRARY_INDEX)
+    library = scan_library(MUSIC_LIBRARY_DIR, previous)
+    if library.rows() != previous.rows():
+        library.save(MUSIC_LIBRARY_INDEX)
+
+def refresh_shared_indexes():
+    refresh_shared_sounds()
+    if MUSIC_LIBRARY_DIR:
+        refresh_shared_library()
+
+def run_shard_worker(worker_index, shard_ids, shard_count):
+    # The supervisor stops workers with SIGTERM, handle it like Ctrl+C so the bot closes cleanly
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(main(shard_ids=shard_ids, shard_count=shard_count))
+    except KeyboardInterrupt:
+        pass
+
+def run_sharded():
+    shard_count, max_concurrency = SHARD_COUNT, 1
+    if not shard_count:
+        shard_count, max_concurrency = asyncio.run(recommended_shards(TOKEN))
+    refresh_shared_indexes()
+    supervisor = ShardSupervisor(
+        run_shard_worker, shard_count, SHARD_WORKERS,
+        max_concurrency=max_concurrency,
+        on_tick=refresh_shared_indexes,
+        tick_interval=SOUND_RESCAN_INTERVAL,
+    )
+    supervisor.run()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if SHARD_WORKERS > 0:
+        run_sharded()
+    else:
+        asyncio.run(main())
\ No newline at end of file
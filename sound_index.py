@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import re
+from functools import cached_property
+from pathlib import Path
+
+from loudness import FLOOR, Loudness, analyze
+from opus_cache import file_digest
+from sound_search import SoundSearch
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 2
+SUPPORTED_EXTS = {'.mp3', '.wav', '.ogg', '.opus', '.flac', '.m4a'}
+# Words in file names that say nothing about the sound
+STOP_WORDS = {'101soundboards', 'mp3'}
+
+
+def tags_for(name):
+    words = re.split(r'[^0-9a-zA-Z]+', Path(name).stem.lower())
+    return tuple(word for word in words if word and word not in STOP_WORDS and not word.isdigit())
+
+
+class Sound:
+    __slots__ = ('name', 'path', 'emoji', 'tags', 'duration', 'size', 'mtime_ns', 'digest', 'loudness')
+
+    def __init__(self, name, path, emoji, tags, duration, size, mtime_ns, digest, loudness=None):
+        self.name = name
+        self.path = path
+        self.emoji = emoji
+        self.tags = tags
+        self.duration = duration
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+        self.loudness = loudness
+
+    @property
+    def label(self):
+        return Path(self.name).stem[:80]
+
+    def gain(self, target, max_peak=-1.0, tolerance=0.0):
+        """Returns the playback gain normalizing this clip to ``target`` LUFS, 1.0 if it wasn't measured."""
+        if self.loudness is None:
+            return 1.0
+        return self.loudness.gain(target, max_peak, tolerance)
+
+    def to_row(self):
+        loudness = self.loudness.to_row() if self.loudness is not None else None
+        return [self.name, self.emoji, list(self.tags), self.duration, self.size, self.mtime_ns, self.digest, loudness]
+
+
+class SoundIndex:
+    """Read-only index of the clips in a sounds directory.
+
+    Built by :func:`scan`, which reuses everything it can from the previous
+    index, and swapped in whole, so readers never see a half-updated index.
+    """
+
+    def __init__(self, root, sounds):
+        self.root = Path(root)
+        self.sounds = sounds
+        self.by_name = {sound.name: sound for sound in sounds}
+        self.by_emoji = {sound.emoji: sound for sound in sounds if sound.emoji}
+        self._pages = {}
+
+    def __len__(self):
+        return len(self.sounds)
+
+    def __iter__(self):
+        return iter(self.sounds)
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    @cached_property
+    def search(self):
+        return SoundSearch(self.sounds)
+
+    @cached_property
+    def numbers(self):
+        """Maps the numbers of the ``!N`` commands to sounds.
+
+        Files named like ``7.mp3`` keep their number, the other sounds are
+        numbered in soundboard order around them.
+        """
+        numbers = {int(Path(sound.name).stem): sound for sound in self.sounds if Path(sound.name).stem.isdigit()}
+        numbered = {id(sound) for sound in numbers.values()}
+        number = 0
+        for sound in self.sounds:
+            if id(sound) in numbered:
+                continue
+            number += 1
+            while number in numbers:
+                number += 1
+            numbers[number] = sound
+        return numbers
+
+    @cached_property
+    def number_of(self):
+        """Maps sound names back to their ``!N`` numbers."""
+        return {sound.name: number for number, sound in self.numbers.items()}
+
+    def pages(self, per_page):
+        """Returns the soundboard pages of ``per_page`` sounds each, computed once per index."""
+        pages = self._pages.get(per_page)
+        if pages is None:
+            pages = tuple(
+                tuple(self.sounds[start:start + per_page])
+                for start in range(0, len(self.sounds), per_page)
+            ) or ((),)
+            self._pages[per_page] = pages
+        return pages
+
+    def rows(self):
+        return [sound.to_row() for sound in self.sounds]
+
+    @classmethod
+    def load(cls, root, manifest):
+        """Loads the index saved in ``manifest``, or an empty one if it's missing or unreadable."""
+        try:
+            with open(manifest, encoding='utf-8') as fp:
+                data = json.load(fp)
+            version = data.get('version')
+            if version not in (1, MANIFEST_VERSION):
+                raise ValueError(f'unsupported manifest version {version}')
+            sounds = []
+            # Version 1 rows have no loudness yet, the next scan measures it
+            for name, emoji, tags, duration, size, mtime_ns, digest, *loudness in data['sounds']:
+                loudness = Loudness(*loudness[0]) if loudness and loudness[0] else None
+                sounds.append(Sound(
+                    name, str(Path(root) / name), emoji, tuple(tags), duration, size, mtime_ns, digest, loudness,
+                ))
+        except FileNotFoundError:
+            sounds = []
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('Ignoring unreadable sound manifest %s: %s', manifest, e)
+            sounds = []
+        return cls(root, sounds)
+
+    def save(self, manifest):
+        manifest = Path(manifest)
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = manifest.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(
+                {'version': MANIFEST_VERSION, 'sounds': self.rows()},
+                fp, ensure_ascii=False, separators=(',', ':'),
+            )
+        os.replace(tmp, manifest)
+
+
+def scan(root, previous=None, *, emojis=None, executable='ffmpeg'):
+    """Blocking: builds a fresh :class:`SoundIndex` of ``root``.
+
+    Files whose size and mtime match ``previous`` are reused as they are;
+    files that changed are re-hashed and only analyzed again (duration and
+    loudness, in one decode) if their content actually differs. ``emojis``
+    maps file names to their button emoji and sets the order of the index,
+    unlisted files come after them by name. An emoji already taken by an
+    earlier file is dropped so it can't shadow it.
+    """
+    root = Path(root)
+    emojis = emojis or {}
+    known = previous.by_name if previous is not None else {}
+    by_digest = {sound.digest: sound for sound in known.values()}
+    sounds = []
+    used_emojis = set()
+    probed = 0
+
+    order = {name: position for position, name in enumerate(emojis)}
+    entries = sorted(os.scandir(root), key=lambda e: (order.get(e.name, len(order)), e.name.lower()))
+    for entry in entries:
+        if not entry.is_file() or Path(entry.name).suffix.lower() not in SUPPORTED_EXTS:
+            continue
+        stat = entry.stat()
+        old = known.get(entry.name)
+        if old is not None and (old.size, old.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            digest = old.digest
+        else:
+            digest = file_digest(entry.path)
+        same = by_digest.get(digest)
+        if same is not None and same.loudness is not None:
+            duration, loudness = same.duration, same.loudness  # unchanged, touched or renamed
+        else:
+            duration, loudness = analyze(entry.path, executable)
+            if loudness is None:
+                # Unmeasurable, play it as it is rather than retrying on every scan
+                loudness = Loudness(FLOOR, FLOOR)
+            probed += 1
+
+        emoji = emojis.get(entry.name)
+        if emoji in used_emojis:
+            logger.debug('Emoji %s of %s is already used, falling back to a label', emoji, entry.name)
+            emoji = None
+        if emoji:
+            used_emojis.add(emoji)
+
+        sounds.append(Sound(
+            entry.name, entry.path, emoji, tags_for(entry.name), duration,
+            stat.st_size, stat.st_mtime_ns, digest, loudness,
+        ))
+
+    if probed:
+        logger.info('Analyzed %d new or changed sounds in %s', probed, root)
+    return SoundIndex(root, sounds)
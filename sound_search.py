@@ -0,0 +1,81 @@
+import heapq
+import re
+from collections import Counter, defaultdict
+
+TOKEN = re.compile(r'[0-9a-z]+')
+MAX_PREFIX = 16
+# Share of a word's trigrams a sound must contain to count as a fuzzy match
+MIN_GRAM_OVERLAP = 0.5
+# Autocomplete asks for the same few prefixes over and over
+RESULT_CACHE_SIZE = 1024
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def trigrams(token):
+    padded = f' {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SoundSearch:
+    """Prefix and trigram index over sound names and tags.
+
+    Every prefix of every word maps straight to the sounds containing it, so
+    typing a word as it appears is a single dict lookup. Words with no prefix
+    hit (typos, words from the middle of a name) fall back to trigram overlap.
+    Whole-word matches rank above prefix matches, shorter names above longer.
+    """
+
+    def __init__(self, sounds):
+        self.sounds = list(sounds)
+        self._words = defaultdict(set)
+        self._prefixes = defaultdict(set)
+        self._grams = defaultdict(set)
+        self._lengths = [len(sound.name) for sound in self.sounds]
+        self._results = {}
+        for position, sound in enumerate(self.sounds):
+            words = set(tokenize(sound.name.rsplit('.', 1)[0])) | set(sound.tags)
+            for word in words:
+                self._words[word].add(position)
+                for length in range(1, min(len(word), MAX_PREFIX) + 1):
+                    self._prefixes[word[:length]].add(position)
+                for gram in trigrams(word):
+                    self._grams[gram].add(position)
+
+    def search(self, query, limit=25):
+        """Returns up to ``limit`` sounds for ``query``, best matches first."""
+        words = tokenize(query)
+        if not words:
+            return self.sounds[:limit]
+        key = (' '.join(words), limit)
+        results = self._results.get(key)
+        if results is None:
+            if len(self._results) >= RESULT_CACHE_SIZE:
+                self._results.clear()
+            results = self._results[key] = self._search(words, limit)
+        return results
+
+    def _search(self, words, limit):
+        scores = Counter()
+        for word in words:
+            matches = self._prefixes.get(word[:MAX_PREFIX])
+            if matches:
+                exact = self._words.get(word, ())
+                for position in matches:
+                    scores[position] += 3 if position in exact else 2
+                continue
+            grams = trigrams(word)
+            overlap = Counter()
+            for gram in grams:
+                for position in self._grams.get(gram, ()):
+                    overlap[position] += 1
+            for position, count in overlap.items():
+                ratio = count / len(grams)
+                if ratio >= MIN_GRAM_OVERLAP:
+                    scores[position] += ratio
+
+        lengths = self._lengths
+        best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], lengths[item[0]], item[0]))
+        return [self.sounds[position] for position, _ in best]
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+from collections import deque
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedTrack:
+    """An entry of a :class:`GuildQueue`, resolved lazily by the prefetcher."""
+    __slots__ = ('query', 'name', 'requester', 'data', 'source', 'task', 'error')
+
+    def __init__(self, query, requester=None, *, name=None):
+        self.query = query
+        self.name = name
+        self.requester = requester
+        self.data = None
+        self.source = None
+        self.task = None
+        self.error = None
+
+    @property
+    def title(self):
+        if self.data:
+            return self.data.get('title', self.query)
+        return self.name or self.query
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+
+class LazyPlaylist:
+    """Stands in the queue for the part of a playlist that hasn't been expanded yet.
+
+    ``entries`` is an async iterator of flat entries (dicts with at least a
+    ``url``); it's only advanced when the placeholder nears the front of the
+    queue, so a long playlist never gets resolved all at once.
+    """
+    __slots__ = ('name', 'entries', 'requester', 'task')
+
+    def __init__(self, name, entries, requester=None):
+        self.name = name
+        self.entries = entries
+        self.requester = requester
+        self.task = None
+
+    @property
+    def title(self):
+        return f'{self.name} (rest of playlist)'
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        if hasattr(self.entries, 'aclose'):
+            asyncio.ensure_future(self.entries.aclose())
+
+
+class GuildQueue:
+    """Per-guild track queue that resolves upcoming tracks while the current one plays.
+
+    ``resolve`` is a coroutine function turning a query into an info dict. The
+    first ``prefetch`` entries are resolved in the background, and when
+    ``open_source`` is given the very next entry also gets its audio source
+    opened ahead of time, so switching tracks doesn't wait on extraction or
+    ffmpeg startup.
+    """
+
+    def __init__(self, resolve, *, prefetch=2, open_source=None):
+        self.resolve = resolve
+        self.prefetch_count = prefetch
+        self.open_source = open_source
+        self.entries = deque()
+        self.current = None
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, track):
+        self.entries.append(track)
+        self.prefetch()
+        return len(self.entries)
+
+    def remove(self, index):
+        """Removes and returns the entry at ``index`` (0-based)."""
+        track = self.entries[index]
+        del self.entries[index]
+        track.cancel()
+        self.prefetch()
+        return track
+
+    def clear(self):
+        for track in self.entries:
+            track.cancel()
+        self.entries.clear()
+
+    async def next(self):
+        """Pops the next playable track, skipping entries that fail to resolve."""
+        while self.entries:
+            if isinstance(self.entries[0], LazyPlaylist):
+                await self._ensure_expanded(self.entries[0])
+                continue
+            track = self.entries.popleft()
+            self.prefetch()
+            try:
+                await self._ensure_resolved(track)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                track.error = e
+                logger.warning('Skipping %r, it failed to resolve: %s', track.query, e)
+                continue
+            return track
+        return None
+
+    def prefetch(self):
+        for track in islice(self.entries, self.prefetch_count):
+            if isinstance(track, LazyPlaylist):
+                # Nothing past an unexpanded playlist is close enough to matter yet
+                if track.task is None:
+                    track.task = asyncio.ensure_future(self._expand(track))
+                break
+            if track.task is None:
+                track.task = asyncio.ensure_future(self._resolve(track))
+        self._open_next()
+
+    def _open_next(self):
+        if self.open_source is None or not self.entries:
+            return
+        track = self.entries[0]
+        if isinstance(track, QueuedTrack) and track.data is not None and track.source is None:
+            try:
+                track.source = self.open_source(track.data)
+            except Exception as e:
+                # Opened again when it's up, where a failure skips it
+                logger.warning('Could not open %r ahead of time: %s', track.query, e)
+
+    async def _ensure_resolved(self, track):
+        if track.task is None:
+            track.task = asyncio.ensure_future(self._resolve(track))
+        await track.task
+
+    async def _ensure_expanded(self, playlist):
+        if playlist.task is None:
+            playlist.task = asyncio.ensure_future(self._expand(playlist))
+        await playlist.task
+
+    async def _expand(self, playlist):
+        """Moves the next few entries of ``playlist`` into the queue, in front of its placeholder."""
+        batch = []
+        exhausted = False
+        try:
+            while len(batch) < max(1, self.prefetch_count):
+                entry = await anext(playlist.entries, None)
+                if entry is None:
+                    exhausted = True
+                    break
+                batch.append(QueuedTrack(entry['url'], playlist.requester, name=entry.get('title')))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('Dropping the rest of playlist %r: %s', playlist.name, e)
+            exhausted = True
+
+        playlist.task = None
+        try:
+            index = self.entries.index(playlist)
+        except ValueError:
+            return  # removed from the queue meanwhile
+        if exhausted:
+            del self.entries[index]
+        for offset, track in enumerate(batch):
+            self.entries.insert(index + offset, track)
+        self.prefetch()
+
+    async def _resolve(self, track):
+        if track.data is None:
+            track.data = await self.resolve(track.query)
+        self._open_next()
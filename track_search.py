@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from extraction import ExtractionError
+
+logger = logging.getLogger(__name__)
+
+
+def query_key(query):
+    return ' '.join(query.lower().split())
+
+
+class TrackSearch:
+    """Suggestions for what's being typed into /play, from flat (metadata-only) searches.
+
+    Keystrokes are debounced per user: a search only starts once a user
+    stopped typing for ``debounce`` seconds, and a newer keystroke supersedes
+    the one still waiting. Results are kept for ``ttl`` seconds in an LRU of
+    ``max_entries`` queries, and a search already running is shared by
+    everyone typing the same thing. Searches that started are never
+    cancelled, that would cost the extraction worker running them; a slow
+    one just fills the cache for the next keystroke.
+
+    ``search`` is a coroutine function taking the query and a result limit
+    and returning entries with ``url``, ``title`` and ``duration``.
+    """
+
+    def __init__(self, search, *, debounce=0.4, ttl=600, max_entries=512, limit=10, min_length=3, timeout=2.5):
+        self._search = search
+        self.debounce = debounce
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.limit = limit
+        self.min_length = min_length
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()  # query key -> (expires_at, entries)
+        self._pending = {}
+        self._typing = {}  # user id -> number of their latest keystroke
+
+    def __len__(self):
+        return len(self._results)
+
+    def get_cached(self, query):
+        key = query_key(query)
+        cached = self._results.get(key)
+        if cached is None:
+            return None
+        expires_at, entries = cached
+        if expires_at <= time.monotonic():
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return entries
+
+    def lookup(self, query):
+        """Returns the top result already found for ``query``, so submitting it doesn't search again."""
+        entries = self.get_cached(query)
+        return entries[0] if entries else None
+
+    async def suggest(self, user_id, query):
+        """Returns the entries to suggest for ``query``, or ``[]`` if it's too short or got superseded."""
+        key = query_key(query)
+        if len(key) < self.min_length:
+            return []
+        entries = self.get_cached(key)
+        if entries is not None:
+            self.hits += 1
+            return entries
+
+        keystroke = self._typing.get(user_id, 0) + 1
+        self._typing[user_id] = keystroke
+        try:
+            await asyncio.sleep(self.debounce)
+            if self._typing.get(user_id) != keystroke:
+                return []  # Still typing, the newer keystroke searches instead
+        finally:
+            if self._typing.get(user_id) == keystroke:
+                del self._typing[user_id]
+
+        entries = self.get_cached(key)
+        if entries is not None:
+            self.hits += 1
+            return entries
+        self.misses += 1
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        try:
+            # Autocomplete has to answer within three seconds, a late result is still cached
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            return []
+
+    async def _fetch(self, key):
+        try:
+            entries = await self._search(key, self.limit)
+        except ExtractionError as e:
+            logger.debug('Search for %r failed: %s', key, e)
+            return []
+        entries = [entry for entry in entries if entry.get('url')]
+        self._results[key] = (time.monotonic() + self.ttl, entries)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+        return entries
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def listeners(channel):
+    """Number of humans in a voice channel."""
+    return sum(1 for member in channel.members if not member.bot)
+
+
+class VoiceSessions:
+    """Owns the bot's voice connections: reuses them, warms them up and drops them when nobody listens.
+
+    Members who used at least ``preconnect_after`` commands count as frequent
+    users; when one of them joins a channel the bot connects (or moves, if it
+    sits alone somewhere else) right away, so their first command doesn't wait
+    on the voice handshake. A connection is closed once its channel has had no
+    humans in it for ``idle_timeout`` seconds.
+    """
+
+    def __init__(self, bot, *, idle_timeout=300, preconnect_after=3, sweep_interval=30, max_users=10000):
+        self.bot = bot
+        self.idle_timeout = idle_timeout
+        self.preconnect_after = preconnect_after
+        self.sweep_interval = sweep_interval
+        self.max_users = max_users
+        self.uses = OrderedDict()  # member id -> number of commands used
+        self._connecting = {}  # guild id -> connect task, so concurrent commands share one handshake
+        self._empty_since = {}  # guild id -> when the bot's channel last lost its listeners
+        self._sweeper = None
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.ensure_future(self._sweep_forever())
+
+    def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    def record_use(self, member_id):
+        self.uses[member_id] = self.uses.pop(member_id, 0) + 1
+        while len(self.uses) > self.max_users:
+            self.uses.popitem(last=False)
+
+    def is_frequent(self, member_id):
+        return self.preconnect_after > 0 and self.uses.get(member_id, 0) >= self.preconnect_after
+
+    async def ensure(self, channel, *, move=False):
+        """Returns a connected voice client for ``channel``'s guild, connecting only if there is none.
+
+        An existing connection in another channel is kept as it is unless
+        ``move`` is set.
+        """
+        guild = channel.guild
+        voice_client = guild.voice_client
+        if voice_client is not None and voice_client.is_connected():
+            if move and voice_client.channel != channel:
+                await voice_client.move_to(channel)
+            return voice_client
+
+        task = self._connecting.get(guild.id)
+        if task is None:
+            task = asyncio.ensure_future(self._connect(channel))
+            self._connecting[guild.id] = task
+            task.add_done_callback(lambda _: self._connecting.pop(guild.id, None))
+        return await asyncio.shield(task)
+
+    async def on_voice_state_update(self, member, before, after):
+        if member.bot or after.channel is None or after.channel == before.channel:
+            return
+        if not self.is_frequent(member.id):
+            return
+        voice_client = member.guild.voice_client
+        if voice_client is not None and voice_client.is_connected() and listeners(voice_client.channel):
+            return  # Busy with someone else, don't follow
+        if not after.channel.permissions_for(member.guild.me).connect:
+            return
+        try:
+            await self.ensure(after.channel, move=True)
+            logger.debug('Pre-connected to %s for %s', after.channel, member)
+        except Exception as e:
+            logger.warning('Could not pre-connect to %s: %s', after.channel, e)
+
+    async def sweep(self):
+        """Disconnects from channels that have been without listeners for ``idle_timeout`` seconds."""
+        now = time.monotonic()
+        for voice_client in list(self.bot.voice_clients):
+            guild_id = voice_client.guild.id
+            if voice_client.channel is not None and listeners(voice_client.channel):
+                self._empty_since.pop(guild_id, None)
+                continue
+            since = self._empty_since.setdefault(guild_id, now)
+            if now - since >= self.idle_timeout:
+                self._empty_since.pop(guild_id, None)
+                logger.info('Leaving %s, nobody listened for %ds', voice_client.channel, now - since)
+                await voice_client.disconnect(force=True)
+        for guild_id in self._empty_since.keys() - {vc.guild.id for vc in self.bot.voice_clients}:
+            del self._empty_since[guild_id]
+
+    async def _connect(self, channel):
+        stale = channel.guild.voice_client
+        if stale is not None:
+            # Left half-connected by a failed handshake or a lost session
+            await stale.disconnect(force=True)
+        # Deafened: Discord then doesn't send the bot the channel's audio at all
+        return await channel.connect(self_deaf=True)
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception('Voice session sweep failed')